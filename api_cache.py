@@ -0,0 +1,157 @@
+from __future__ import annotations
+import logging
+import pickle
+import threading
+import time
+import typing
+from collections import OrderedDict
+from pathlib import Path
+from config import API_CACHE_PATH, API_CACHE_SIZE, API_CACHE_TTL
+from sqlite_store import connect
+
+logger = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+Key = typing.Hashable
+
+
+class ApiCache:
+    """TTL and LRU bounded cache for Apple Music and iTunes responses.
+
+    Entries live in memory and, when ``path`` is set, are also pickled to
+    SQLite so they survive a restart. Only successful calls are cached.
+    """
+
+    def __init__(
+        self,
+        path: Path | None = API_CACHE_PATH,
+        max_size: int = API_CACHE_SIZE,
+        ttl: int = API_CACHE_TTL,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries: OrderedDict[Key, tuple[float, typing.Any]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.connection = None
+        if path is not None:
+            self.connection = connect(path)
+            self._create_tables()
+
+    def _create_tables(self):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value BLOB, created_at REAL)"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_created_at "
+                "ON responses (created_at)"
+            )
+
+    def get_or_call(
+        self,
+        key: Key,
+        func: typing.Callable[..., T],
+        *args,
+        **kwargs,
+    ) -> T:
+        """Return the cached result for ``key``, calling ``func`` on a miss."""
+        found, value = self.get(key)
+        if found:
+            return value
+        value = func(*args, **kwargs)
+        self.set(key, value)
+        return value
+
+    def get(self, key: Key) -> tuple[bool, typing.Any]:
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._is_expired(entry[0], now):
+                del self.entries[key]
+                entry = None
+            if entry is None and self.connection is not None:
+                entry = self._load(key, now)
+                if entry is not None:
+                    self._store_memory(key, entry)
+            if entry is None:
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[1]
+
+    def set(self, key: Key, value: typing.Any):
+        entry = (time.time(), value)
+        with self._lock:
+            self._store_memory(key, entry)
+            if self.connection is None:
+                return
+            try:
+                blob = pickle.dumps(value)
+            except Exception as e:
+                logger.debug(f"Not caching {key!r} on disk: {e}")
+                return
+            with self.connection:
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, created_at) "
+                    "VALUES (?, ?, ?)",
+                    (repr(key), blob, entry[0]),
+                )
+                (count,) = self.connection.execute(
+                    "SELECT COUNT(*) FROM responses"
+                ).fetchone()
+                if count > self.max_size:
+                    # Evicting a tenth at once keeps the next inserts from
+                    # evicting again.
+                    self.connection.execute(
+                        "DELETE FROM responses WHERE rowid IN "
+                        "(SELECT rowid FROM responses ORDER BY created_at LIMIT ?)",
+                        (count - self.max_size + self.max_size // 10,),
+                    )
+
+    def _load(self, key: Key, now: float) -> tuple[float, typing.Any] | None:
+        row = self.connection.execute(
+            "SELECT value, created_at FROM responses WHERE key = ?",
+            (repr(key),),
+        ).fetchone()
+        if row is None:
+            return None
+        if self._is_expired(row[1], now):
+            with self.connection:
+                self.connection.execute(
+                    "DELETE FROM responses WHERE key = ?", (repr(key),)
+                )
+            return None
+        try:
+            return row[1], pickle.loads(row[0])
+        except Exception as e:
+            logger.debug(f"Dropping unreadable cache entry {key!r}: {e}")
+            return None
+
+    def _store_memory(self, key: Key, entry: tuple[float, typing.Any]):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return bool(self.ttl) and now - created_at > self.ttl
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute("DELETE FROM responses")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+    def __len__(self) -> int:
+        return len(self.entries)
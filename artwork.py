@@ -0,0 +1,175 @@
+from __future__ import annotations
+import hashlib
+import io
+import logging
+import os
+import threading
+import typing
+from collections import defaultdict
+from pathlib import Path
+import requests
+from config import ARTWORK_CACHE_PATH, ARTWORK_CACHE_BUDGET, THUMBNAIL_SIZE
+from http_pool import mount_http_adapter
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SUFFIX = ".thumb.jpg"
+
+
+class ArtworkCache:
+    """Cover art kept on disk, shared by every track and request.
+
+    Each cover URL (which carries the requested size) is fetched once and
+    stored under its hash twice: as is, for embedding and saving next to
+    the tracks, and as a JPEG of at most ``thumbnail_size`` pixels that
+    Telegram accepts as a thumbnail. Once the files exceed ``budget``
+    bytes, the least recently used covers are deleted.
+
+    The directory is its own index, with a cover's modification time as
+    its last use, so worker processes sharing it see each other's covers
+    and evictions.
+    """
+
+    def __init__(
+        self,
+        path: Path = ARTWORK_CACHE_PATH,
+        budget: int = ARTWORK_CACHE_BUDGET,
+        thumbnail_size: int = THUMBNAIL_SIZE,
+    ):
+        self.path = path
+        self.budget = budget
+        self.thumbnail_size = thumbnail_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.http_session = requests.Session()
+        mount_http_adapter(self.http_session)
+        self._lock = threading.Lock()
+        self._fetch_locks: defaultdict[str, threading.Lock] = defaultdict(
+            threading.Lock
+        )
+        path.mkdir(parents=True, exist_ok=True)
+
+    def get_path(self, url: str) -> Path:
+        """Return the full-size cover, fetching it on first use."""
+        key = self._get_key(url)
+        cover_path = self.path / key
+        # Tracks of one album ask for the same cover at the same time, only
+        # the first one downloads it.
+        with self._get_fetch_lock(key):
+            try:
+                os.utime(cover_path)
+                cached = self._get_thumbnail_path(key).exists()
+            except FileNotFoundError:
+                cached = False
+            with self._lock:
+                if cached:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if not cached:
+                self._store(key, self.fetch(url))
+        if not cached:
+            self.evict(keep=key)
+        return cover_path
+
+    def get_bytes(self, url: str) -> bytes:
+        """Drop-in for ``Downloader.get_url_response_bytes``."""
+        return self._read(url, lambda key: self.path / key)
+
+    def get_thumbnail(self, url: str) -> bytes:
+        return self._read(url, self._get_thumbnail_path)
+
+    def save(self, cover_path: Path, url: str):
+        """Write the cover to ``cover_path``, as ``Downloader.save_cover`` would."""
+        cover_path.parent.mkdir(parents=True, exist_ok=True)
+        cover_path.write_bytes(self.get_bytes(url))
+
+    def fetch(self, url: str) -> bytes:
+        response = self.http_session.get(url, timeout=30)
+        response.raise_for_status()
+        return response.content
+
+    def evict(self, keep: str | None = None):
+        if not self.budget:
+            return
+        with self._lock:
+            covers = self._scan()
+            total = sum(size for _, _, size in covers)
+            for _, key, size in covers:
+                if total <= self.budget:
+                    break
+                if key == keep:
+                    continue
+                (self.path / key).unlink(missing_ok=True)
+                self._get_thumbnail_path(key).unlink(missing_ok=True)
+                self._fetch_locks.pop(key, None)
+                total -= size
+                self.evictions += 1
+
+    def get_size(self) -> int:
+        with self._lock:
+            return sum(size for _, _, size in self._scan())
+
+    def _scan(self) -> list[tuple[float, str, int]]:
+        """Every complete cover as ``(last use, key, bytes)``, oldest first."""
+        covers = []
+        for cover_path in self.path.iterdir():
+            # Thumbnails and partial files have a suffix, covers do not.
+            if "." in cover_path.name:
+                continue
+            try:
+                cover_stat = cover_path.stat()
+                thumbnail_stat = self._get_thumbnail_path(cover_path.name).stat()
+            except FileNotFoundError:
+                continue
+            covers.append(
+                (
+                    cover_stat.st_mtime,
+                    cover_path.name,
+                    cover_stat.st_size + thumbnail_stat.st_size,
+                )
+            )
+        return sorted(covers)
+
+    def _read(self, url: str, get_path: typing.Callable[[str], Path]) -> bytes:
+        try:
+            self.get_path(url)
+            return get_path(self._get_key(url)).read_bytes()
+        except FileNotFoundError:
+            # Another process evicted the cover in between, fetch it again.
+            self.get_path(url)
+            return get_path(self._get_key(url)).read_bytes()
+
+    def _store(self, key: str, data: bytes):
+        # Pillow is only needed once a cover is fetched, not at startup.
+        from PIL import Image
+
+        image = Image.open(io.BytesIO(data))
+        image = image.convert("RGB")
+        image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        thumbnail = io.BytesIO()
+        image.save(thumbnail, "JPEG", quality=85)
+        # The thumbnail goes first: a cover without one counts as missing,
+        # so a crash in between never leaves a half entry.
+        self._write(self._get_thumbnail_path(key), thumbnail.getvalue())
+        self._write(self.path / key, data)
+
+    def _get_fetch_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._fetch_locks[key]
+
+    @staticmethod
+    def _get_key(url: str) -> str:
+        return hashlib.sha256(url.encode()).hexdigest()
+
+    def _get_thumbnail_path(self, key: str) -> Path:
+        return self.path / f"{key}{THUMBNAIL_SUFFIX}"
+
+    @staticmethod
+    def _write(path: Path, data: bytes):
+        # Per process, as workers sharing the directory may fetch the same
+        # cover at once.
+        partial_path = path.with_name(f".{path.name}.{os.getpid()}.partial")
+        partial_path.write_bytes(data)
+        partial_path.replace(path)
@@ -0,0 +1,544 @@
+"""Offline benchmark for the download pipeline.
+
+Drives ``main()`` with synthetic updates against fake Apple Music, gamdl
+and Telegram backends, so no cookies, ``.wvd`` file or bot token are
+needed. Latencies and payload sizes are configurable; every scenario
+reports throughput, per-track latency percentiles and peak RSS.
+
+    python benchmark.py --scenario album --album-size 30
+"""
+
+from __future__ import annotations
+import argparse
+import asyncio
+import io
+import itertools
+import os
+import resource
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+
+SCENARIOS = (
+    "song",
+    "album",
+    "music-video",
+    "concurrent",
+    "repeat",
+    "duplicate",
+    "crossed",
+)
+
+track_ids = itertools.count(1)
+
+
+@dataclass
+class Settings:
+    api_latency: float
+    download_rate: float
+    track_size: int
+    video_size: int
+    process_latency: float
+    upload_rate: float
+    album_size: int
+    users: int
+
+
+def sleep_for_size(size: int, rate: float):
+    if rate:
+        time.sleep(size / rate)
+
+
+class FakeAppleMusicApi:
+    storefront = "us"
+    language = "en-US"
+
+    def __init__(self, settings: Settings):
+        self.settings = settings
+
+    def get_webplayback(self, track_id: str) -> dict:
+        time.sleep(self.settings.api_latency)
+        return {"id": track_id}
+
+
+class FakeItunesApi:
+    def __init__(self, settings: Settings):
+        self.settings = settings
+
+    def get_itunes_page(self, media_type: str, media_id: str) -> dict:
+        time.sleep(self.settings.api_latency)
+        return {"id": media_id}
+
+
+class FakeDownloader:
+    """Stands in for ``gamdl.downloader.Downloader``, writing real files."""
+
+    ffmpeg_path_full = shutil.which("ffmpeg")
+
+    def __init__(self, settings: Settings, output_path: Path, temp_path: Path):
+        self.settings = settings
+        self.output_path = output_path
+        self.temp_path = temp_path
+        self.albums: dict[str, list[dict]] = {}
+
+    def get_url_info(self, url: str) -> SimpleNamespace:
+        url_type, url_id = url.rstrip("/").split("/")[-2:]
+        return SimpleNamespace(type=url_type, id=url_id)
+
+    def get_download_queue(self, url_info: SimpleNamespace) -> SimpleNamespace:
+        time.sleep(self.settings.api_latency)
+        return SimpleNamespace(
+            tracks_metadata=self.albums[url_info.id],
+            playlist_attributes=None,
+        )
+
+    def get_final_path(self, tags: dict, file_extension: str) -> Path:
+        return self.output_path / tags["album"] / f'{tags["title"]}{file_extension}'
+
+    def get_cover_url(self, track_metadata: dict) -> str:
+        album = track_metadata["attributes"].get("albumName", "bench")
+        return f"https://example.invalid/{album}.jpg"
+
+    def get_cover_file_extension(self, cover_url: str) -> str:
+        return ".jpg"
+
+    def get_playlist_tags(self, playlist_attributes: dict, playlist_track: int) -> dict:
+        return {}
+
+    def get_decryption_key(self, pssh: str, track_id: str) -> str:
+        time.sleep(self.settings.api_latency)
+        return "00" * 16
+
+    def download(self, path: Path, stream_url: str):
+        size = int(stream_url.rsplit("/", 1)[-1])
+        sleep_for_size(size, self.settings.download_rate)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as file:
+            file.truncate(size)
+
+    def download_ytdlp(self, path: Path, stream_url: str):
+        self.download(path, stream_url)
+
+    def process(self, input_path: Path, output_path: Path):
+        time.sleep(self.settings.process_latency)
+        shutil.copyfile(input_path, output_path)
+
+    def apply_tags(self, path: Path, tags: dict, cover_url: str):
+        time.sleep(self.settings.process_latency)
+
+    def move_to_output_path(self, remuxed_path: Path, final_path: Path):
+        final_path.parent.mkdir(parents=True, exist_ok=True)
+        shutil.move(remuxed_path, final_path)
+
+    def cleanup_temp_path(self):
+        shutil.rmtree(self.temp_path, ignore_errors=True)
+
+
+class FakeSubDownloader:
+    """Covers the song, legacy song, music video and post downloaders."""
+
+    def __init__(self, downloader: FakeDownloader):
+        self.downloader = downloader
+
+    @property
+    def settings(self) -> Settings:
+        return self.downloader.settings
+
+    def get_lyrics(self, track_metadata: dict) -> SimpleNamespace:
+        time.sleep(self.settings.api_latency)
+        return SimpleNamespace(synced=None, unsynced=None)
+
+    def get_tags(self, *args) -> dict:
+        track_metadata = args[-1] if len(args) == 3 else args[0]
+        attributes = track_metadata.get("attributes", {})
+        return {
+            "title": f'{track_metadata.get("id")} {attributes.get("name", "")}',
+            "album": attributes.get("albumName", "bench"),
+        }
+
+    def get_cover_path(self, final_path: Path, file_extension: str) -> Path:
+        return final_path.parent / f"Cover{file_extension}"
+
+    def get_lyrics_synced_path(self, final_path: Path) -> Path:
+        return final_path.with_suffix(".lrc")
+
+    def get_stream_info(self, track_metadata_or_webplayback: dict) -> SimpleNamespace:
+        time.sleep(self.settings.api_latency)
+        return SimpleNamespace(
+            stream_url=f"https://example.invalid/{self.settings.track_size}",
+            pssh="pssh",
+            codec="aac",
+        )
+
+    def get_stream_info_video(self, m3u8_data: dict) -> SimpleNamespace:
+        return SimpleNamespace(
+            stream_url=f"https://example.invalid/{self.settings.video_size}",
+            pssh="pssh-video",
+            codec="h264",
+        )
+
+    def get_stream_info_audio(self, m3u8_data: dict) -> SimpleNamespace:
+        return SimpleNamespace(
+            stream_url=f"https://example.invalid/{self.settings.track_size}",
+            pssh="pssh-audio",
+            codec="aac",
+        )
+
+    def get_decryption_key(self, pssh: str, track_id: str) -> str:
+        return self.downloader.get_decryption_key(pssh, track_id)
+
+    def get_music_video_id_alt(self, track_metadata: dict) -> str:
+        return track_metadata["id"]
+
+    def get_stream_url_from_itunes_page(self, itunes_page: dict) -> str:
+        return "https://example.invalid/master.m3u8"
+
+    def get_stream_url_from_webplayback(self, webplayback: dict) -> str:
+        return "https://example.invalid/master.m3u8"
+
+    def get_m3u8_master_data(self, stream_url: str) -> dict:
+        time.sleep(self.settings.api_latency)
+        return {"playlists": []}
+
+    def get_stream_url(self, track_metadata: dict) -> str:
+        return f"https://example.invalid/{self.settings.video_size}"
+
+    def get_path(self, track_id: str, name: str) -> Path:
+        return self.downloader.temp_path / f"{track_id}_{name}"
+
+    def get_encrypted_path(self, track_id: str) -> Path:
+        return self.get_path(track_id, "encrypted.m4a")
+
+    def get_decrypted_path(self, track_id: str) -> Path:
+        return self.get_path(track_id, "decrypted.m4a")
+
+    def get_remuxed_path(self, track_id: str) -> Path:
+        return self.get_path(track_id, "remuxed.m4a")
+
+    def get_encrypted_path_video(self, track_id: str) -> Path:
+        return self.get_path(track_id, "encrypted_video.mp4")
+
+    def get_encrypted_path_audio(self, track_id: str) -> Path:
+        return self.get_path(track_id, "encrypted_audio.m4a")
+
+    def get_decrypted_path_video(self, track_id: str) -> Path:
+        return self.get_path(track_id, "decrypted_video.mp4")
+
+    def get_decrypted_path_audio(self, track_id: str) -> Path:
+        return self.get_path(track_id, "decrypted_audio.m4a")
+
+    def get_post_temp_path(self, track_id: str) -> Path:
+        return self.get_path(track_id, "post.m4v")
+
+    def decrypt(self, encrypted_path: Path, *args):
+        decrypted_path = args[0] if isinstance(args[0], Path) else args[1]
+        self.downloader.process(encrypted_path, decrypted_path)
+
+    def remux(self, *args):
+        # The output path always comes last among the path arguments.
+        paths = [arg for arg in args if isinstance(arg, Path)]
+        self.downloader.process(paths[0], paths[-1])
+
+    def save_lyrics_synced(self, path: Path, lyrics: str):
+        path.write_text(lyrics)
+
+
+@dataclass
+class FakeMessage:
+    bot: FakeBot
+    chat_id: int
+    file_id: str | None = None
+
+    @property
+    def effective_attachment(self) -> SimpleNamespace | None:
+        if self.file_id is None:
+            return None
+        return SimpleNamespace(file_id=self.file_id)
+
+    async def edit_text(self, text: str, **kwargs):
+        await asyncio.sleep(self.bot.latency)
+        self.bot.calls += 1
+        return self
+
+
+@dataclass
+class FakeBot:
+    """Records what would have been sent and when each track arrived."""
+
+    latency: float
+    upload_rate: float
+    id: int = 1
+    calls: int = 0
+    file_ids: itertools.count = field(default_factory=lambda: itertools.count(1))
+    deliveries: dict[int, list[float]] = field(default_factory=dict)
+
+    async def _send(self, chat_id: int, media) -> FakeMessage:
+        size = get_payload_size(media)
+        await asyncio.sleep(self.latency + self.get_upload_time(size))
+        self.calls += 1
+        self.deliveries.setdefault(chat_id, []).append(time.perf_counter())
+        file_id = media if isinstance(media, str) else f"file-{next(self.file_ids)}"
+        return FakeMessage(self, chat_id, file_id)
+
+    def get_upload_time(self, size: int) -> float:
+        return size / self.upload_rate if self.upload_rate else 0.0
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> FakeMessage:
+        await asyncio.sleep(self.latency)
+        self.calls += 1
+        return FakeMessage(self, chat_id)
+
+    async def send_audio(self, chat_id: int, audio, **kwargs) -> FakeMessage:
+        return await self._send(chat_id, audio)
+
+    async def send_video(self, chat_id: int, video, **kwargs) -> FakeMessage:
+        return await self._send(chat_id, video)
+
+    async def send_media_group(self, chat_id: int, media: list, **kwargs) -> list:
+        size = sum(get_payload_size(item.media) for item in media)
+        await asyncio.sleep(self.latency + self.get_upload_time(size))
+        self.calls += 1
+        now = time.perf_counter()
+        self.deliveries.setdefault(chat_id, []).extend(now for _ in media)
+        return [
+            FakeMessage(self, chat_id, f"file-{next(self.file_ids)}") for _ in media
+        ]
+
+
+def get_payload_size(media) -> int:
+    if isinstance(media, Path):
+        return media.stat().st_size
+    content = getattr(media, "input_file_content", None)
+    return len(content) if content is not None else 0
+
+
+def make_track(track_type: str, album: str) -> dict:
+    return {
+        "id": str(next(track_ids)),
+        "type": track_type,
+        "attributes": {
+            "name": "Track",
+            "artistName": "Benchmark",
+            "albumName": album,
+            "durationInMillis": 200_000,
+            "playParams": {"id": "bench"},
+        },
+    }
+
+
+def make_update(user_id: int, urls: list[str]) -> SimpleNamespace:
+    async def reply_text(text: str, **kwargs):
+        return None
+
+    return SimpleNamespace(
+        message=SimpleNamespace(
+            from_user=SimpleNamespace(id=user_id),
+            chat_id=user_id,
+            message_id=1,
+            text=" ".join(urls),
+            reply_text=reply_text,
+        )
+    )
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+async def run_scenario(
+    name: str, settings: Settings, bot: FakeBot, downloader: FakeDownloader, app
+) -> dict:
+    from main import main
+
+    requests: list[tuple[int, list[str]]] = []
+    if name == "song":
+        track = make_track("songs", f"song-{next(track_ids)}")
+        downloader.albums[track["id"]] = [track]
+        requests.append((1, [f"https://music.apple.com/us/song/{track['id']}"]))
+    elif name == "music-video":
+        track = make_track("music-videos", f"video-{next(track_ids)}")
+        downloader.albums[track["id"]] = [track]
+        requests.append((1, [f"https://music.apple.com/us/music-video/{track['id']}"]))
+    elif name in ("duplicate", "crossed"):
+        # Tracks repeated within one album ([X, Y, X]) or shared by two
+        # albums in opposite order ([X, Y, Z] and [Z, Y, X]) wait on each
+        # other's claims while those sit in a media group buffer.
+        album_id = f"album-{next(track_ids)}"
+        tracks = [make_track("songs", album_id) for _ in range(3)]
+        if name == "duplicate":
+            albums = [[tracks[0], tracks[1], tracks[0]]]
+        else:
+            albums = [tracks, tracks[::-1]]
+        for user_id, album in enumerate(albums, 1):
+            downloader.albums[f"{album_id}-{user_id}"] = album
+            requests.append(
+                (user_id, [f"https://music.apple.com/us/album/{album_id}-{user_id}"])
+            )
+    else:
+        users = settings.users if name == "concurrent" else 1
+        for user_id in range(1, users + 1):
+            album_id = f"album-{next(track_ids)}"
+            downloader.albums[album_id] = [
+                make_track("songs", album_id) for _ in range(settings.album_size)
+            ]
+            urls = [f"https://music.apple.com/us/album/{album_id}"]
+            if name == "repeat":
+                # The second request is served from the file_id cache.
+                urls *= 2
+            requests.append((user_id, urls))
+    bot.deliveries.clear()
+    calls = bot.calls
+    started_at = time.perf_counter()
+    await asyncio.gather(
+        *(
+            main(
+                make_update(user_id, urls),
+                SimpleNamespace(bot=bot, bot_data=app.bot_data),
+            )
+            for user_id, urls in requests
+        )
+    )
+    elapsed = time.perf_counter() - started_at
+    latencies = [
+        delivered_at - started_at
+        for deliveries in bot.deliveries.values()
+        for delivered_at in deliveries
+    ]
+    return {
+        "scenario": name,
+        "tracks": len(latencies),
+        "seconds": elapsed,
+        "tracks_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "telegram_calls": bot.calls - calls,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+async def run(args: argparse.Namespace):
+    import artwork
+    import session
+    from PIL import Image
+    from main import post_init, post_stop, post_shutdown
+
+    settings = Settings(
+        api_latency=args.api_latency,
+        download_rate=args.download_rate,
+        track_size=args.track_size,
+        video_size=args.video_size,
+        process_latency=args.process_latency,
+        upload_rate=args.upload_rate,
+        album_size=args.album_size,
+        users=args.users,
+    )
+    downloader = FakeDownloader(
+        settings,
+        session.downloader_config.output_path,
+        session.downloader_config.temp_path,
+    )
+
+    def build(self: session.DownloaderSession) -> session.Components:
+        return session.Components(
+            apple_music_api=FakeAppleMusicApi(settings),
+            itunes_api=FakeItunesApi(settings),
+            downloader=downloader,
+            downloader_song=FakeSubDownloader(downloader),
+            downloader_song_legacy=FakeSubDownloader(downloader),
+            downloader_music_video=FakeSubDownloader(downloader),
+            downloader_post=FakeSubDownloader(downloader),
+            skip_mv=False,
+            cache=self.cache,
+            artwork=self.artwork,
+        )
+
+    def fetch_artwork(self: artwork.ArtworkCache, url: str) -> bytes:
+        time.sleep(settings.api_latency)
+        cover = io.BytesIO()
+        Image.new("RGB", (1200, 1200)).save(cover, "JPEG")
+        return cover.getvalue()
+
+    session.DownloaderSession.build = build
+    artwork.ArtworkCache.fetch = fetch_artwork
+    bot = FakeBot(args.telegram_latency, args.upload_rate)
+    tasks = []
+
+    def create_task(coroutine):
+        task = asyncio.create_task(coroutine)
+        tasks.append(task)
+        return task
+
+    app = SimpleNamespace(bot=bot, bot_data={}, create_task=create_task)
+    await post_init(app)
+    try:
+        scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+        for name in scenarios:
+            result = await run_scenario(name, settings, bot, downloader, app)
+            print(
+                f'{result["scenario"]:<12} tracks={result["tracks"]:<4} '
+                f'time={result["seconds"]:.2f}s '
+                f'throughput={result["tracks_per_second"]:.2f}/s '
+                f'p50={result["p50"]:.2f}s p99={result["p99"]:.2f}s '
+                f'telegram_calls={result["telegram_calls"]} '
+                f'peak_rss={result["peak_rss_mb"]:.1f}MB'
+            )
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await post_stop(app)
+        await post_shutdown(app)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--scenario", choices=("all", *SCENARIOS), default="all")
+    parser.add_argument("--album-size", type=int, default=30)
+    parser.add_argument("--users", type=int, default=8)
+    parser.add_argument("--api-latency", type=float, default=0.05)
+    parser.add_argument("--download-rate", type=float, default=20e6)
+    parser.add_argument("--process-latency", type=float, default=0.05)
+    parser.add_argument("--track-size", type=int, default=8_000_000)
+    parser.add_argument("--video-size", type=int, default=40_000_000)
+    parser.add_argument("--telegram-latency", type=float, default=0.05)
+    parser.add_argument("--upload-rate", type=float, default=10e6)
+    parser.add_argument(
+        "--unthrottled",
+        action="store_true",
+        help="disable the Telegram rate limiter to measure the pipeline alone",
+    )
+    args = parser.parse_args()
+    work_path = Path(tempfile.mkdtemp(prefix="amdl-bench-"))
+    # config.py reads the environment on import, so everything is pointed
+    # at the scratch directory before the bot's modules are loaded.
+    os.environ.update(
+        TELEGRAM_ADMIN_ID=",".join(str(user_id) for user_id in range(args.users + 1)),
+        FILE_ID_CACHE_PATH=str(work_path / "file_ids.sqlite3"),
+        JOB_STORE_PATH=str(work_path / "jobs.sqlite3"),
+        LIBRARY_INDEX_PATH=str(work_path / "library.sqlite3"),
+        ARTWORK_CACHE_PATH=str(work_path / "artwork"),
+        METRICS_PORT="0",
+    )
+    if args.unthrottled:
+        os.environ.update(
+            TELEGRAM_RATE="1000000",
+            TELEGRAM_BURST="1000000",
+            TELEGRAM_CHAT_RATE="1000000",
+            TELEGRAM_CHAT_BURST="1000000",
+            PROGRESS_EDIT_INTERVAL="0",
+        )
+    os.chdir(work_path)
+    try:
+        asyncio.run(run(args))
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+from __future__ import annotations
+import asyncio
+import typing
+
+Key = typing.Hashable
+
+
+class InFlightTracks:
+    """Tracks that some job is currently downloading, so others can wait for them.
+
+    The first job to ``claim`` a key downloads the track and ``resolve``s it
+    with the uploaded ``file_id``, or ``None`` if it failed. Every other job
+    claiming the same key meanwhile gets a future to await instead.
+
+    A fetched track can sit in its job's media group buffer for a while
+    before it is uploaded. The job ``hold``s the key with a callback that
+    sends the buffer right away, which is called as soon as anyone waits
+    for that key, so waiters never depend on the buffer filling up.
+    """
+
+    def __init__(self):
+        self.futures: dict[Key, asyncio.Future] = {}
+        self.flushes: dict[Key, typing.Callable[[], None]] = {}
+        # Keys that have waiters, so a later ``hold`` flushes at once.
+        self.wanted: set[Key] = set()
+        self.coalesced = 0
+
+    def claim(self, key: Key) -> asyncio.Future | None:
+        """Return the future to wait on, or ``None`` if the caller should download."""
+        future = self.futures.get(key)
+        if future is not None:
+            self.coalesced += 1
+            self.wanted.add(key)
+            self._flush(key)
+            return future
+        self.futures[key] = asyncio.get_running_loop().create_future()
+        return None
+
+    def hold(self, key: Key, flush: typing.Callable[[], None]):
+        """Note that the claimed track is buffered and ``flush`` would send it."""
+        if key not in self.futures:
+            return
+        self.flushes[key] = flush
+        if key in self.wanted:
+            self._flush(key)
+
+    def resolve(self, key: Key, file_id: str | None):
+        self.flushes.pop(key, None)
+        self.wanted.discard(key)
+        future = self.futures.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(file_id)
+
+    def _flush(self, key: Key):
+        flush = self.flushes.pop(key, None)
+        if flush is not None:
+            flush()
+
+    def __len__(self) -> int:
+        return len(self.futures)
@@ -1,3 +1,6 @@
+import os
+import socket
+from pathlib import Path
 from decouple import config
 
 TELEGRAM_TOKEN = config("TELEGRAM_TOKEN", default="")
@@ -6,3 +9,76 @@ TELEGRAM_ADMIN_ID = config(
     default="",
     cast=lambda v: [int(i) for i in filter(str.isdigit, (s.strip() for s in v.split(',')))]
 )
+SESSION_REFRESH_INTERVAL = config("SESSION_REFRESH_INTERVAL", default=6 * 60 * 60, cast=int)
+SESSION_CHECK_INTERVAL = config("SESSION_CHECK_INTERVAL", default=60, cast=int)
+WORKER_THREADS = config("WORKER_THREADS", default=8, cast=int)
+MAX_CONCURRENT_JOBS = config("MAX_CONCURRENT_JOBS", default=4, cast=int)
+MAX_JOBS_PER_USER = config("MAX_JOBS_PER_USER", default=1, cast=int)
+MAX_CONCURRENT_UPDATES = config("MAX_CONCURRENT_UPDATES", default=64, cast=int)
+PIPELINE_PREPARE_WORKERS = config("PIPELINE_PREPARE_WORKERS", default=2, cast=int)
+PIPELINE_FETCH_WORKERS = config("PIPELINE_FETCH_WORKERS", default=2, cast=int)
+PIPELINE_QUEUE_SIZE = config("PIPELINE_QUEUE_SIZE", default=2, cast=int)
+FILE_ID_CACHE_PATH = config("FILE_ID_CACHE_PATH", default="./data/file_ids.sqlite3", cast=Path)
+FILE_ID_CACHE_SIZE = config("FILE_ID_CACHE_SIZE", default=50000, cast=int)
+FILE_ID_CACHE_TTL = config("FILE_ID_CACHE_TTL", default=0, cast=int)
+STREAM_THREADS = config("STREAM_THREADS", default=8, cast=int)
+JOB_STORE_PATH = config("JOB_STORE_PATH", default="./data/jobs.sqlite3", cast=Path)
+JOB_STORE_RETENTION = config("JOB_STORE_RETENTION", default=7 * 24 * 60 * 60, cast=int)
+API_CACHE_PATH = config("API_CACHE_PATH", default="", cast=lambda v: Path(v) if v else None)
+API_CACHE_SIZE = config("API_CACHE_SIZE", default=4096, cast=int)
+API_CACHE_TTL = config("API_CACHE_TTL", default=60 * 60, cast=int)
+TELEGRAM_RATE = config("TELEGRAM_RATE", default=25, cast=float)
+TELEGRAM_BURST = config("TELEGRAM_BURST", default=30, cast=int)
+TELEGRAM_CHAT_RATE = config("TELEGRAM_CHAT_RATE", default=1, cast=float)
+TELEGRAM_CHAT_BURST = config("TELEGRAM_CHAT_BURST", default=3, cast=int)
+TELEGRAM_MAX_RETRIES = config("TELEGRAM_MAX_RETRIES", default=5, cast=int)
+PROGRESS_EDIT_INTERVAL = config("PROGRESS_EDIT_INTERVAL", default=3, cast=float)
+MEDIA_GROUP_SIZE = config("MEDIA_GROUP_SIZE", default=10, cast=int)
+TELEGRAM_API_URL = config("TELEGRAM_API_URL", default="")
+UPLOAD_SIZE_LIMIT = config(
+    "UPLOAD_SIZE_LIMIT",
+    default=2000 * 1000 * 1000 if TELEGRAM_API_URL else 50 * 1000 * 1000,
+    cast=int,
+)
+TEMP_RAM_PATH = config("TEMP_RAM_PATH", default="", cast=lambda v: Path(v) if v else None)
+TEMP_RAM_BUDGET = config("TEMP_RAM_BUDGET", default=512 * 1024 * 1024, cast=int)
+LIBRARY_INDEX_PATH = config("LIBRARY_INDEX_PATH", default="./data/library.sqlite3", cast=Path)
+LIBRARY_BUDGET = config("LIBRARY_BUDGET", default=20 * 1024 * 1024 * 1024, cast=int)
+METRICS_HOST = config("METRICS_HOST", default="127.0.0.1")
+METRICS_PORT = config("METRICS_PORT", default=9464, cast=int)
+JOB_TIMING_SUMMARY = config("JOB_TIMING_SUMMARY", default=False, cast=bool)
+WEBHOOK_URL = config("WEBHOOK_URL", default="")
+WEBHOOK_LISTEN = config("WEBHOOK_LISTEN", default="0.0.0.0")
+WEBHOOK_PORT = config("WEBHOOK_PORT", default=8080, cast=int)
+WEBHOOK_PATH = config("WEBHOOK_PATH", default="telegram")
+WEBHOOK_SECRET = config("WEBHOOK_SECRET", default="")
+MAX_CONCURRENT_TRACKS = config("MAX_CONCURRENT_TRACKS", default=4, cast=int)
+MAX_TRACKS_PER_USER = config("MAX_TRACKS_PER_USER", default=2, cast=int)
+USER_DAILY_QUOTA = config("USER_DAILY_QUOTA", default=0, cast=int)
+HTTP_POOL_SIZE = config("HTTP_POOL_SIZE", default=32, cast=int)
+HTTP_RETRIES = config("HTTP_RETRIES", default=3, cast=int)
+STREAM_FRAGMENT_THREADS = config("STREAM_FRAGMENT_THREADS", default=4, cast=int)
+STREAM_RETRIES = config("STREAM_RETRIES", default=3, cast=int)
+STREAM_CHUNK_SIZE = config("STREAM_CHUNK_SIZE", default=10 * 1024 * 1024, cast=int)
+ARTWORK_CACHE_PATH = config("ARTWORK_CACHE_PATH", default="./data/artwork", cast=Path)
+ARTWORK_CACHE_BUDGET = config("ARTWORK_CACHE_BUDGET", default=512 * 1024 * 1024, cast=int)
+THUMBNAIL_SIZE = config("THUMBNAIL_SIZE", default=320, cast=int)
+COOKIES_PATH = config("COOKIES_PATH", default="./data/cookies.txt", cast=Path)
+OUTPUT_PATH = config("OUTPUT_PATH", default="./Apple Music", cast=Path)
+TEMP_PATH = config("TEMP_PATH", default="./temp", cast=Path)
+WVD_PATH = config("WVD_PATH", default="", cast=lambda v: Path(v) if v else None)
+LANGUAGE = config("LANGUAGE", default="en-US")
+CODEC_SONG = config("CODEC_SONG", default="aac-legacy")
+CODEC_MUSIC_VIDEO = config("CODEC_MUSIC_VIDEO", default="h264")
+QUALITY_POST = config("QUALITY_POST", default="best")
+COVER_SIZE = config("COVER_SIZE", default=320, cast=int)
+FFMPEG_PATH = config("FFMPEG_PATH", default="ffmpeg")
+MP4DECRYPT_PATH = config("MP4DECRYPT_PATH", default="mp4decrypt")
+NM3U8DLRE_PATH = config("NM3U8DLRE_PATH", default="N_m3u8DL-RE")
+MP4BOX_PATH = config("MP4BOX_PATH", default="MP4Box")
+MODE = config("MODE", default="all")
+WORKER_ID = config("WORKER_ID", default=f"{socket.gethostname()}-{os.getpid()}")
+WORKER_POLL_INTERVAL = config("WORKER_POLL_INTERVAL", default=1.0, cast=float)
+WORKER_LEASE = config("WORKER_LEASE", default=60, cast=int)
+DEFAULT_PROFILE = config("DEFAULT_PROFILE", default="standard")
+FAST_PROFILE_BUDGET = config("FAST_PROFILE_BUDGET", default=20 * 1024 * 1024, cast=int)
@@ -0,0 +1,155 @@
+from __future__ import annotations
+import asyncio
+import datetime
+import logging
+import time
+import typing
+from collections import defaultdict
+from telegram import Bot, Message
+from telegram.error import RetryAfter, TelegramError
+from config import (
+    TELEGRAM_RATE,
+    TELEGRAM_BURST,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_MAX_RETRIES,
+    PROGRESS_EDIT_INTERVAL,
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated_at) * self.rate
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class TelegramLimiter:
+    """Paces Bot API calls to stay under Telegram's flood limits.
+
+    Every call takes a token from a global bucket and from its chat's
+    bucket. If Telegram still answers with ``RetryAfter``, the call is
+    repeated after the requested delay.
+    """
+
+    def __init__(
+        self,
+        rate: float = TELEGRAM_RATE,
+        burst: int = TELEGRAM_BURST,
+        chat_rate: float = TELEGRAM_CHAT_RATE,
+        chat_burst: int = TELEGRAM_CHAT_BURST,
+        max_retries: int = TELEGRAM_MAX_RETRIES,
+    ):
+        self.bucket = TokenBucket(rate, burst)
+        self.chat_buckets: dict[int, TokenBucket] = defaultdict(
+            lambda: TokenBucket(chat_rate, chat_burst)
+        )
+        self.max_retries = max_retries
+        self.retries = 0
+
+    async def call(
+        self,
+        chat_id: int,
+        func: typing.Callable[..., typing.Awaitable[T]],
+        /,
+        *args,
+        **kwargs,
+    ) -> T:
+        attempt = 0
+        while True:
+            await self.chat_buckets[chat_id].acquire()
+            await self.bucket.acquire()
+            try:
+                with metrics.timer(f"telegram_{func.__name__}"):
+                    return await func(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                metrics.inc("telegram_retries_total")
+                retry_after = e.retry_after
+                if isinstance(retry_after, datetime.timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Telegram flood limit hit, retrying in {retry_after}s")
+                await asyncio.sleep(retry_after)
+
+
+class ProgressMessage:
+    """A single status message per job, edited in place at a throttled rate.
+
+    Intermediate texts that arrive faster than ``interval`` are coalesced,
+    only the latest one is shown on the next edit.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        limiter: TelegramLimiter,
+        chat_id: int,
+        reply_to_message_id: int | None,
+        interval: float = PROGRESS_EDIT_INTERVAL,
+    ):
+        self.bot = bot
+        self.limiter = limiter
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.interval = interval
+        self.message: Message | None = None
+        self.text: str | None = None
+        self.shown_text: str | None = None
+        self.edited_at = 0.0
+
+    async def update(self, text: str):
+        self.text = text
+        if time.monotonic() - self.edited_at >= self.interval:
+            await self.flush()
+
+    async def flush(self):
+        """Show the latest text now, whatever the throttle says."""
+        text = self.text
+        if text is None or text == self.shown_text:
+            return
+        self.edited_at = time.monotonic()
+        self.shown_text = text
+        try:
+            if self.message is None:
+                self.message = await self.limiter.call(
+                    self.chat_id,
+                    self.bot.send_message,
+                    chat_id=self.chat_id,
+                    text=text,
+                    reply_to_message_id=self.reply_to_message_id,
+                    # The request may be gone by the time a resumed job runs.
+                    allow_sending_without_reply=True,
+                )
+            else:
+                await self.limiter.call(
+                    self.chat_id,
+                    self.message.edit_text,
+                    text,
+                )
+        except TelegramError as e:
+            # Editing to identical text, a deleted message or a timeout is
+            # not worth failing a download over.
+            logger.debug(f"Could not update progress message: {e}")
@@ -0,0 +1,532 @@
+from __future__ import annotations
+import contextvars
+import copy
+import functools
+import logging
+import threading
+import typing
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from pathlib import Path
+from gamdl.constants import LEGACY_CODECS
+from gamdl.models import DownloadQueue, Lyrics, StreamInfo, UrlInfo
+from config import STREAM_THREADS
+from metrics import metrics
+from session import Components, downloader_config
+
+logger = logging.getLogger(__name__)
+
+playlist_file_lock = threading.Lock()
+
+# Separate from the worker pool so a worker waiting on its streams can
+# never starve the threads it is waiting for.
+stream_executor = ThreadPoolExecutor(
+    max_workers=STREAM_THREADS,
+    thread_name_prefix="stream",
+)
+
+T = typing.TypeVar("T")
+
+
+def run_concurrently(*calls: typing.Callable[[], T]) -> list[T]:
+    """Run independent blocking calls side by side, results in call order.
+
+    Waits for every call to finish before raising the first error so no
+    call is left writing into a temp directory that is being cleaned up.
+    """
+    futures = [
+        stream_executor.submit(contextvars.copy_context().run, call) for call in calls
+    ]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+@dataclass
+class PreparedTrack:
+    """Everything fetched from Apple before the stream itself is downloaded."""
+
+    tags: dict
+    final_path: Path
+    cover_url: str
+    cover_path: Path
+    playlist_track: int | None
+    download: bool = True
+    lyrics: Lyrics | None = None
+    lyrics_synced_path: Path | None = None
+    stream_url: str | None = None
+    stream_info: StreamInfo | None = None
+    decryption_key: str | None = None
+    stream_info_audio: StreamInfo | None = None
+    decryption_key_audio: str | None = None
+
+
+@dataclass
+class TrackResult:
+    final_path: Path
+    cover_path: Path
+
+
+def is_video(track_type: str) -> bool:
+    return track_type in ("music-videos", "uploaded-videos")
+
+
+def prepare_track(
+    components: Components,
+    url_info: UrlInfo,
+    download_queue: DownloadQueue,
+    download_index: int,
+    track_metadata: dict,
+    queue_progress: str,
+) -> PreparedTrack | None:
+    """Get tags, stream info and decryption keys, ``None`` if the track is skipped.
+
+    This stage only talks to Apple, so it can run for the next track while
+    the previous one is still downloading or being remuxed.
+    """
+    downloader = components.downloader
+    if download_queue.playlist_attributes:
+        playlist_track = download_index
+    else:
+        playlist_track = None
+    if not track_metadata["attributes"].get("playParams"):
+        logger.warning(f"({queue_progress}) Track is not streamable, skipping")
+        return None
+    if (
+        (downloader_config.synced_lyrics_only and track_metadata["type"] != "songs")
+        or (track_metadata["type"] == "music-videos" and components.skip_mv)
+        or (
+            track_metadata["type"] == "music-videos"
+            and url_info.type == "album"
+            and not downloader_config.disable_music_video_skip
+        )
+    ):
+        logger.warning(
+            f"({queue_progress}) Track is not downloadable with current configuration, skipping"
+        )
+        return None
+    elif track_metadata["type"] == "songs":
+        prepared_track = prepare_song(components, track_metadata, queue_progress)
+    elif track_metadata["type"] == "music-videos":
+        prepared_track = prepare_music_video(
+            components, track_metadata, queue_progress
+        )
+    elif track_metadata["type"] == "uploaded-videos":
+        prepared_track = prepare_post(components, track_metadata, queue_progress)
+    else:
+        return None
+    if prepared_track is None:
+        return None
+    if playlist_track:
+        prepared_track.tags = {
+            **prepared_track.tags,
+            **downloader.get_playlist_tags(
+                download_queue.playlist_attributes,
+                playlist_track,
+            ),
+        }
+    prepared_track.playlist_track = playlist_track
+    return prepared_track
+
+
+def prepare_song(
+    components: Components,
+    track_metadata: dict,
+    queue_progress: str,
+) -> PreparedTrack | None:
+    downloader = components.downloader
+    downloader_song = components.downloader_song
+    downloader_song_legacy = components.downloader_song_legacy
+    logger.debug("Getting lyrics")
+    lyrics = components.cached(
+        "lyrics", track_metadata["id"], downloader_song.get_lyrics, track_metadata
+    )
+    logger.debug("Getting webplayback")
+    webplayback = components.cached(
+        "webplayback",
+        track_metadata["id"],
+        components.apple_music_api.get_webplayback,
+        track_metadata["id"],
+    )
+    tags = downloader_song.get_tags(webplayback, lyrics.unsynced)
+    final_path = downloader.get_final_path(tags, ".m4a")
+    cover_url = downloader.get_cover_url(track_metadata)
+    cover_file_extesion = downloader.get_cover_file_extension(cover_url)
+    prepared_track = PreparedTrack(
+        tags=tags,
+        final_path=final_path,
+        cover_url=cover_url,
+        cover_path=downloader_song.get_cover_path(final_path, cover_file_extesion),
+        playlist_track=None,
+        lyrics=lyrics,
+        lyrics_synced_path=downloader_song.get_lyrics_synced_path(final_path),
+    )
+    if downloader_config.synced_lyrics_only:
+        prepared_track.download = False
+    elif final_path.exists() and not downloader_config.overwrite:
+        logger.warning(
+            f'({queue_progress}) Song already exists at "{final_path}", skipping'
+        )
+        prepared_track.download = False
+    else:
+        logger.debug("Getting stream info")
+        codec_song = components.profile.get_song_codec(track_metadata)
+        if codec_song in LEGACY_CODECS:
+            if codec_song != downloader_song_legacy.codec:
+                downloader_song_legacy = copy.copy(downloader_song_legacy)
+                downloader_song_legacy.codec = codec_song
+            with metrics.timer("stream_info"):
+                stream_info = downloader_song_legacy.get_stream_info(webplayback)
+            logger.debug("Getting decryption key")
+            decryption_key = components.cached(
+                "decryption_key_legacy",
+                stream_info.pssh,
+                downloader_song_legacy.get_decryption_key,
+                stream_info.pssh,
+                track_metadata["id"],
+            )
+        else:
+            with metrics.timer("stream_info"):
+                stream_info = downloader_song.get_stream_info(track_metadata)
+            if not stream_info.stream_url or not stream_info.pssh:
+                logger.warning(
+                    f"({queue_progress}) Song is not downloadable or is not"
+                    " available in the chosen codec, skipping"
+                )
+                return None
+            logger.debug("Getting decryption key")
+            decryption_key = components.cached(
+                "decryption_key",
+                stream_info.pssh,
+                downloader.get_decryption_key,
+                stream_info.pssh,
+                track_metadata["id"],
+            )
+        prepared_track.stream_info = stream_info
+        prepared_track.decryption_key = decryption_key
+    return prepared_track
+
+
+def prepare_music_video(
+    components: Components,
+    track_metadata: dict,
+    queue_progress: str,
+) -> PreparedTrack:
+    downloader = components.downloader
+    downloader_music_video = components.downloader_music_video
+    music_video_id_alt = downloader_music_video.get_music_video_id_alt(
+        track_metadata
+    )
+    logger.debug("Getting iTunes page")
+    itunes_page = components.cached(
+        "itunes_page",
+        music_video_id_alt,
+        components.itunes_api.get_itunes_page,
+        "music-video",
+        music_video_id_alt,
+    )
+    if music_video_id_alt == track_metadata["id"]:
+        stream_url = downloader_music_video.get_stream_url_from_itunes_page(
+            itunes_page
+        )
+    else:
+        logger.debug("Getting webplayback")
+        webplayback = components.cached(
+            "webplayback",
+            track_metadata["id"],
+            components.apple_music_api.get_webplayback,
+            track_metadata["id"],
+        )
+        stream_url = downloader_music_video.get_stream_url_from_webplayback(
+            webplayback
+        )
+    logger.debug("Getting M3U8 data")
+    with metrics.timer("m3u8"):
+        m3u8_data = downloader_music_video.get_m3u8_master_data(stream_url)
+    tags = downloader_music_video.get_tags(
+        music_video_id_alt,
+        itunes_page,
+        track_metadata,
+    )
+    final_path = downloader.get_final_path(tags, ".m4v")
+    cover_url = downloader.get_cover_url(track_metadata)
+    cover_file_extesion = downloader.get_cover_file_extension(cover_url)
+    prepared_track = PreparedTrack(
+        tags=tags,
+        final_path=final_path,
+        cover_url=cover_url,
+        cover_path=downloader_music_video.get_cover_path(
+            final_path,
+            cover_file_extesion,
+        ),
+        playlist_track=None,
+    )
+    if final_path.exists() and not downloader_config.overwrite:
+        logger.warning(
+            f'({queue_progress}) Music video already exists at "{final_path}", skipping'
+        )
+        prepared_track.download = False
+    else:
+        logger.debug("Getting stream info")
+        m3u8_data = {
+            **m3u8_data,
+            "playlists": components.profile.fit_playlists(
+                track_metadata, m3u8_data["playlists"]
+            ),
+        }
+        stream_info_video, stream_info_audio = run_concurrently(
+            functools.partial(
+                metrics.timed(
+                    "stream_info", downloader_music_video.get_stream_info_video
+                ),
+                m3u8_data,
+            ),
+            functools.partial(
+                metrics.timed(
+                    "stream_info", downloader_music_video.get_stream_info_audio
+                ),
+                m3u8_data,
+            ),
+        )
+        logger.debug("Getting decryption keys")
+        decryption_key_video, decryption_key_audio = run_concurrently(
+            functools.partial(
+                components.cached,
+                "decryption_key",
+                stream_info_video.pssh,
+                downloader.get_decryption_key,
+                stream_info_video.pssh,
+                track_metadata["id"],
+            ),
+            functools.partial(
+                components.cached,
+                "decryption_key",
+                stream_info_audio.pssh,
+                downloader.get_decryption_key,
+                stream_info_audio.pssh,
+                track_metadata["id"],
+            ),
+        )
+        prepared_track.stream_info = stream_info_video
+        prepared_track.stream_info_audio = stream_info_audio
+        prepared_track.decryption_key = decryption_key_video
+        prepared_track.decryption_key_audio = decryption_key_audio
+    return prepared_track
+
+
+def prepare_post(
+    components: Components,
+    track_metadata: dict,
+    queue_progress: str,
+) -> PreparedTrack:
+    downloader = components.downloader
+    tags = components.downloader_post.get_tags(track_metadata)
+    final_path = downloader.get_final_path(tags, ".m4v")
+    cover_url = downloader.get_cover_url(track_metadata)
+    cover_file_extesion = downloader.get_cover_file_extension(cover_url)
+    prepared_track = PreparedTrack(
+        tags=tags,
+        final_path=final_path,
+        cover_url=cover_url,
+        cover_path=components.downloader_music_video.get_cover_path(
+            final_path,
+            cover_file_extesion,
+        ),
+        playlist_track=None,
+        stream_url=components.downloader_post.get_stream_url(track_metadata),
+    )
+    if final_path.exists() and not downloader_config.overwrite:
+        logger.warning(
+            f'({queue_progress}) Post video already exists at "{final_path}", skipping'
+        )
+        prepared_track.download = False
+    return prepared_track
+
+
+def fetch_track(
+    components: Components,
+    download_queue: DownloadQueue,
+    track_metadata: dict,
+    prepared_track: PreparedTrack,
+) -> TrackResult:
+    """Download, decrypt, remux and tag a prepared track into the output path."""
+    downloader = components.downloader
+    remuxed_path = None
+    if prepared_track.download:
+        if track_metadata["type"] == "songs":
+            remuxed_path = fetch_song(components, track_metadata, prepared_track)
+        elif track_metadata["type"] == "music-videos":
+            remuxed_path = fetch_music_video(
+                components, track_metadata, prepared_track
+            )
+        elif track_metadata["type"] == "uploaded-videos":
+            remuxed_path = components.downloader_post.get_post_temp_path(
+                track_metadata["id"]
+            )
+            logger.debug(f'Downloading to "{remuxed_path}"')
+            with metrics.timer("download"):
+                downloader.download_ytdlp(remuxed_path, prepared_track.stream_url)
+            metrics.inc("bytes_total", remuxed_path.stat().st_size, stage="download")
+    lyrics = prepared_track.lyrics
+    lyrics_synced_path = prepared_track.lyrics_synced_path
+    if lyrics is None or downloader_config.no_synced_lyrics or not lyrics.synced:
+        pass
+    elif lyrics_synced_path.exists() and not downloader_config.overwrite:
+        logger.debug(
+            f'Synced lyrics already exists at "{lyrics_synced_path}", skipping'
+        )
+    else:
+        logger.debug(f'Saving synced lyrics to "{lyrics_synced_path}"')
+        with metrics.timer("lyrics_save"):
+            components.downloader_song.save_lyrics_synced(
+                lyrics_synced_path, lyrics.synced
+            )
+    cover_path = prepared_track.cover_path
+    if downloader_config.synced_lyrics_only or not downloader_config.save_cover:
+        pass
+    elif cover_path.exists() and not downloader_config.overwrite:
+        logger.debug(f'Cover already exists at "{cover_path}", skipping')
+    else:
+        logger.debug(f'Saving cover to "{cover_path}"')
+        with metrics.timer("cover"):
+            components.artwork.save(cover_path, prepared_track.cover_url)
+    final_path = prepared_track.final_path
+    if remuxed_path:
+        logger.debug("Applying tags")
+        with metrics.timer("tags"):
+            downloader.apply_tags(
+                remuxed_path, prepared_track.tags, prepared_track.cover_url
+            )
+        logger.debug(f'Moving to "{final_path}"')
+        with metrics.timer("move"):
+            downloader.move_to_output_path(remuxed_path, final_path)
+    if (
+        not downloader_config.synced_lyrics_only
+        and downloader_config.save_playlist
+        and download_queue.playlist_attributes
+    ):
+        playlist_file_path = downloader.get_playlist_file_path(prepared_track.tags)
+        logger.debug(f'Updating M3U8 playlist from "{playlist_file_path}"')
+        with playlist_file_lock:
+            downloader.update_playlist_file(
+                playlist_file_path,
+                final_path,
+                prepared_track.playlist_track,
+            )
+    return TrackResult(final_path, cover_path)
+
+
+def fetch_song(
+    components: Components,
+    track_metadata: dict,
+    prepared_track: PreparedTrack,
+) -> Path:
+    downloader_song = components.downloader_song
+    stream_info = prepared_track.stream_info
+    encrypted_path = downloader_song.get_encrypted_path(track_metadata["id"])
+    decrypted_path = downloader_song.get_decrypted_path(track_metadata["id"])
+    remuxed_path = downloader_song.get_remuxed_path(track_metadata["id"])
+    logger.debug(f'Downloading to "{encrypted_path}"')
+    download_stream(components, encrypted_path, stream_info.stream_url)
+    if components.profile.codec_song in LEGACY_CODECS:
+        logger.debug(f'Decrypting/Remuxing to "{decrypted_path}"/"{remuxed_path}"')
+        with metrics.timer("remux"):
+            components.downloader_song_legacy.remux(
+                encrypted_path,
+                decrypted_path,
+                remuxed_path,
+                prepared_track.decryption_key,
+            )
+    else:
+        logger.debug(f'Decrypting to "{decrypted_path}"')
+        with metrics.timer("decrypt"):
+            downloader_song.decrypt(
+                encrypted_path, decrypted_path, prepared_track.decryption_key
+            )
+        logger.debug(f'Remuxing to "{remuxed_path}"')
+        with metrics.timer("remux"):
+            downloader_song.remux(
+                decrypted_path,
+                remuxed_path,
+                stream_info.codec,
+            )
+    return remuxed_path
+
+
+def fetch_music_video(
+    components: Components,
+    track_metadata: dict,
+    prepared_track: PreparedTrack,
+) -> Path:
+    downloader_music_video = components.downloader_music_video
+    stream_info_video = prepared_track.stream_info
+    stream_info_audio = prepared_track.stream_info_audio
+    encrypted_path_video = downloader_music_video.get_encrypted_path_video(
+        track_metadata["id"]
+    )
+    encrypted_path_audio = downloader_music_video.get_encrypted_path_audio(
+        track_metadata["id"]
+    )
+    decrypted_path_video = downloader_music_video.get_decrypted_path_video(
+        track_metadata["id"]
+    )
+    decrypted_path_audio = downloader_music_video.get_decrypted_path_audio(
+        track_metadata["id"]
+    )
+    remuxed_path = downloader_music_video.get_remuxed_path(track_metadata["id"])
+    # The two streams are independent until they are remuxed together, so
+    # each one is downloaded and decrypted on its own thread.
+    run_concurrently(
+        functools.partial(
+            fetch_music_video_stream,
+            components,
+            "video",
+            stream_info_video,
+            prepared_track.decryption_key,
+            encrypted_path_video,
+            decrypted_path_video,
+        ),
+        functools.partial(
+            fetch_music_video_stream,
+            components,
+            "audio",
+            stream_info_audio,
+            prepared_track.decryption_key_audio,
+            encrypted_path_audio,
+            decrypted_path_audio,
+        ),
+    )
+    logger.debug(f'Remuxing to "{remuxed_path}"')
+    with metrics.timer("remux"):
+        downloader_music_video.remux(
+            decrypted_path_video,
+            decrypted_path_audio,
+            remuxed_path,
+            stream_info_video.codec,
+            stream_info_audio.codec,
+        )
+    return remuxed_path
+
+
+def fetch_music_video_stream(
+    components: Components,
+    stream_type: str,
+    stream_info: StreamInfo,
+    decryption_key: str,
+    encrypted_path: Path,
+    decrypted_path: Path,
+):
+    logger.debug(f'Downloading {stream_type} to "{encrypted_path}"')
+    download_stream(components, encrypted_path, stream_info.stream_url)
+    logger.debug(f'Decrypting {stream_type} to "{decrypted_path}"')
+    with metrics.timer("decrypt"):
+        components.downloader_music_video.decrypt(
+            encrypted_path,
+            decryption_key,
+            decrypted_path,
+        )
+
+
+def download_stream(components: Components, path: Path, stream_url: str):
+    with metrics.timer("download"):
+        components.downloader.download(path, stream_url)
+    metrics.inc("bytes_total", path.stat().st_size, stage="download")
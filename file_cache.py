@@ -0,0 +1,128 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+from pathlib import Path
+from config import FILE_ID_CACHE_PATH, FILE_ID_CACHE_SIZE, FILE_ID_CACHE_TTL
+from sqlite_store import connect
+
+logger = logging.getLogger(__name__)
+
+
+class FileIdCache:
+    """Telegram ``file_id``s of already delivered tracks, stored in SQLite.
+
+    Entries are keyed by Apple Music track id, codec and cover size. A
+    ``file_id`` is only valid for the bot that uploaded it, so the whole
+    cache is dropped when the bot behind the token changes.
+    """
+
+    def __init__(
+        self,
+        bot_id: str,
+        path: Path = FILE_ID_CACHE_PATH,
+        max_size: int = FILE_ID_CACHE_SIZE,
+        ttl: int = FILE_ID_CACHE_TTL,
+    ):
+        self.bot_id = bot_id
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.connection = connect(path)
+        self._create_tables()
+        self._check_bot_id()
+
+    def _create_tables(self):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_ids ("
+                "track_id TEXT, codec TEXT, cover_size INTEGER, file_id TEXT, "
+                "created_at REAL, last_used REAL, "
+                "PRIMARY KEY (track_id, codec, cover_size))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids (last_used)"
+            )
+
+    def _check_bot_id(self):
+        with self._lock, self.connection:
+            row = self.connection.execute(
+                "SELECT value FROM meta WHERE key = 'bot_id'"
+            ).fetchone()
+            if row is not None and row[0] == self.bot_id:
+                return
+            if row is not None:
+                logger.warning("Bot changed, clearing the file_id cache")
+            self.connection.execute("DELETE FROM file_ids")
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('bot_id', ?)",
+                (self.bot_id,),
+            )
+
+    def get(self, track_id: str, codec: str, cover_size: int) -> str | None:
+        now = time.time()
+        with self._lock, self.connection:
+            row = self.connection.execute(
+                "SELECT file_id, created_at FROM file_ids "
+                "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                (track_id, codec, cover_size),
+            ).fetchone()
+            if row is not None and self.ttl and now - row[1] > self.ttl:
+                self.connection.execute(
+                    "DELETE FROM file_ids "
+                    "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                    (track_id, codec, cover_size),
+                )
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute(
+                "UPDATE file_ids SET last_used = ? "
+                "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                (now, track_id, codec, cover_size),
+            )
+            self.hits += 1
+            return row[0]
+
+    def set(self, track_id: str, codec: str, cover_size: int, file_id: str):
+        now = time.time()
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO file_ids "
+                "(track_id, codec, cover_size, file_id, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (track_id, codec, cover_size, file_id, now, now),
+            )
+            (count,) = self.connection.execute(
+                "SELECT COUNT(*) FROM file_ids"
+            ).fetchone()
+            if count > self.max_size:
+                # Evicting a tenth at once keeps the next inserts from
+                # evicting again.
+                self.connection.execute(
+                    "DELETE FROM file_ids WHERE rowid IN "
+                    "(SELECT rowid FROM file_ids ORDER BY last_used LIMIT ?)",
+                    (count - self.max_size + self.max_size // 10,),
+                )
+
+    def invalidate(self, track_id: str, codec: str, cover_size: int):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM file_ids "
+                "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                (track_id, codec, cover_size),
+            )
+
+    def clear(self):
+        with self._lock, self.connection:
+            self.connection.execute("DELETE FROM file_ids")
+
+    def close(self):
+        self.connection.close()
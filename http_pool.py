@@ -0,0 +1,23 @@
+from __future__ import annotations
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from config import HTTP_POOL_SIZE, HTTP_RETRIES
+
+# One connection pool for every API session, kept across session rebuilds
+# so refreshing the cookies does not drop the warm keep-alive connections.
+http_adapter = HTTPAdapter(
+    pool_connections=HTTP_POOL_SIZE,
+    pool_maxsize=HTTP_POOL_SIZE,
+    max_retries=Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+    ),
+)
+
+
+def mount_http_adapter(session: requests.Session):
+    session.mount("https://", http_adapter)
+    session.mount("http://", http_adapter)
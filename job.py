@@ -0,0 +1,597 @@
+from __future__ import annotations
+import asyncio
+import logging
+import shutil
+import uuid
+from pathlib import Path
+from telegram import Bot, InputMediaAudio, Message
+from telegram.error import BadRequest
+from config import (
+    PIPELINE_PREPARE_WORKERS,
+    PIPELINE_FETCH_WORKERS,
+    PIPELINE_QUEUE_SIZE,
+    MEDIA_GROUP_SIZE,
+    UPLOAD_SIZE_LIMIT,
+    JOB_TIMING_SUMMARY,
+    USER_DAILY_QUOTA,
+)
+from coalesce import InFlightTracks
+from delivery import ProgressMessage, TelegramLimiter
+from download import (
+    PreparedTrack,
+    TrackResult,
+    fetch_track,
+    is_video,
+    prepare_track,
+)
+from file_cache import FileIdCache
+from job_store import JobRecord, JobStore
+from library import LibraryIndex
+from metrics import JobTimings, job_timings, metrics
+from pipeline import Pipeline, PipelineItem, Stage
+from pool import WorkerPool
+from profiles import get_profile
+from scheduler import QuotaExceeded, get_priority
+from session import Components, DownloaderSession, SessionError, downloader_config
+from temp_space import TempSpace, estimate_temp_size
+from transcode import fit_to_size
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadJob:
+    """Downloads every track behind one URL and sends them to the chat.
+
+    Progress is recorded in the job store, so a job that is run again after
+    a restart only processes the tracks that were not finished.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        bot_data: dict,
+        components: Components,
+        record: JobRecord,
+    ):
+        self.bot = bot
+        self.session: DownloaderSession = bot_data["session"]
+        self.pool: WorkerPool = bot_data["pool"]
+        self.file_id_cache: FileIdCache = bot_data["file_id_cache"]
+        self.job_store: JobStore = bot_data["job_store"]
+        self.in_flight: InFlightTracks = bot_data["in_flight"]
+        self.library: LibraryIndex = bot_data["library"]
+        self.temp_space: TempSpace = bot_data["temp_space"]
+        self.limiter: TelegramLimiter = bot_data["telegram_limiter"]
+        self.profile = get_profile(record.profile)
+        self.components = components.with_profile(self.profile)
+        # When the session's components were built, to notice a rebuild.
+        self.built_at = self.session.created_at
+        self.record = record
+        self.chat_id = record.chat_id
+        self.url = record.url
+        self.url_progress = record.url_progress
+        self.user_id = record.user_id
+        self.priority = get_priority(record.url)
+        self.progress = ProgressMessage(
+            bot, self.limiter, record.chat_id, record.message_id
+        )
+        # Every job gets its own temp directory so concurrent jobs never
+        # clean up each other's files.
+        self.temp_name = uuid.uuid4().hex
+        self.temp_path = downloader_config.temp_path / self.temp_name
+        self.url_info = None
+        self.download_queue = None
+        self.finished_positions: set[int] = set()
+        # Positions this job claimed in ``in_flight``, resolved on delivery.
+        self.claims: dict[int, tuple[str, str, int]] = {}
+        # Fetched tracks waiting to be sent together as one media group.
+        self.uploads: list[PipelineItem] = []
+        # Keeps uploads in order when another job asks for an early flush.
+        self.upload_lock = asyncio.Lock()
+        self.flush_tasks: set[asyncio.Task] = set()
+        self.error_count = 0
+        self.timings = JobTimings()
+
+    async def run(self) -> int:
+        """Process the URL and return the number of errors."""
+        job_timings.set(self.timings)
+        await self.pool.run(self.job_store.set_job_status, self.record.id, "running")
+        # A cancelled job is left "running" on purpose: it is resumed on the
+        # next start.
+        try:
+            error_count = await self._run()
+        except Exception:
+            await self.pool.run(
+                self.job_store.set_job_status, self.record.id, "failed"
+            )
+            metrics.inc("jobs_total", status="failed")
+            raise
+        await self.pool.run(self.job_store.set_job_status, self.record.id, "done")
+        metrics.inc("jobs_total", status="done")
+        return error_count
+
+    async def _run(self) -> int:
+        try:
+            await self.check_quota()
+        except QuotaExceeded as e:
+            logger.warning(f"({self.url_progress}) {e}")
+            await self.limiter.call(
+                self.chat_id,
+                self.bot.send_message,
+                chat_id=self.chat_id,
+                text=f"({self.url_progress}) {e}",
+                reply_to_message_id=self.record.message_id,
+            )
+            return 1
+        try:
+            logger.info(f'({self.url_progress}) Checking "{self.url}"')
+            # Only a regex parse of the URL, not worth a cache round trip.
+            self.url_info = self.components.downloader.get_url_info(self.url)
+            if self.url_info.type == "song" and await self.send_cached(
+                "songs", self.profile.get_cache_key("songs", self.url_info.id)
+            ):
+                return 0
+            self.download_queue = await self.pool.run(
+                self.components.cached,
+                "download_queue",
+                self.url,
+                self.components.downloader.get_download_queue,
+                self.url_info,
+            )
+            await self.pool.run(
+                self.job_store.add_tracks,
+                self.record.id,
+                [
+                    track_metadata["id"]
+                    for track_metadata in self.download_queue.tracks_metadata
+                ],
+            )
+            self.finished_positions = await self.pool.run(
+                self.job_store.get_finished_positions, self.record.id
+            )
+        except Exception as e:
+            metrics.inc("errors_total", stage="check", type=type(e).__name__)
+            logger.error(
+                f'({self.url_progress}) Failed to check "{self.url}"',
+                exc_info=downloader_config.print_exceptions,
+            )
+            await self.pool.run(self.session.handle_error, e, self.built_at)
+            return 1
+        pipeline = Pipeline(
+            [
+                Stage("prepare", self.prepare, PIPELINE_PREPARE_WORKERS),
+                Stage("fetch", self.fetch, PIPELINE_FETCH_WORKERS),
+            ],
+            queue_size=PIPELINE_QUEUE_SIZE,
+        )
+        try:
+            await pipeline.run(self.download_queue.tracks_metadata, self.deliver)
+            await self.flush_uploads()
+            if self.progress.text is not None:
+                self.progress.text = (
+                    f"({self.url_progress}) Done ({self.error_count} error(s))"
+                )
+                if JOB_TIMING_SUMMARY:
+                    self.progress.text += "\n\n" + self.timings.format()
+                await self.progress.flush()
+        finally:
+            for task in self.flush_tasks:
+                task.cancel()
+            # Never leave other jobs waiting on a track this one gave up on.
+            for cache_key in self.claims.values():
+                self.in_flight.resolve(cache_key, None)
+            self.claims.clear()
+            for root in self.temp_space.roots():
+                if (root / self.temp_name).exists():
+                    await self.pool.run(
+                        shutil.rmtree, root / self.temp_name, ignore_errors=True
+                    )
+        return self.error_count
+
+    def get_queue_progress(self, item: PipelineItem) -> str:
+        return f"Track {item.position + 1}/{len(self.download_queue.tracks_metadata)} from {self.url_progress}"
+
+    async def set_track_stage(self, item: PipelineItem, stage: str):
+        await self.pool.run(
+            self.job_store.set_track_stage, self.record.id, item.position, stage
+        )
+
+    async def prepare(
+        self, item: PipelineItem
+    ) -> PreparedTrack | TrackResult | str | None:
+        if item.position in self.finished_positions:
+            return None
+        self.update_components()
+        # The components this track was prepared with, see ``fail``.
+        item.results["built_at"] = self.built_at
+        track_metadata = item.data
+        cache_key = self.profile.get_cache_key(
+            track_metadata["type"], track_metadata["id"]
+        )
+        while True:
+            # Claimed before the first await, so the positions of a job
+            # claim in order and never wait on a later position of another
+            # job that is itself stuck behind this one.
+            future = self.in_flight.claim(cache_key)
+            if future is None:
+                self.claims[item.position] = cache_key
+                file_id = await self.pool.run(self.file_id_cache.get, *cache_key)
+                if file_id is not None:
+                    logger.info(
+                        f'({self.get_queue_progress(item)}) "{track_metadata["attributes"]["name"]}" was sent before, reusing it'
+                    )
+                    self.resolve_claim(item, file_id)
+                    break
+                result = await self.pool.run(self.library.get, *cache_key)
+                if result is not None:
+                    logger.info(
+                        f'({self.get_queue_progress(item)}) "{track_metadata["attributes"]["name"]}" is already on disk, reusing it'
+                    )
+                    item.results["fetch"] = result
+                    item.done = True
+                    return result
+                return await self.prepare_uncached(item)
+            logger.info(
+                f'({self.get_queue_progress(item)}) "{track_metadata["attributes"]["name"]}" is already being downloaded, waiting for it'
+            )
+            # Shielded so a cancelled waiter does not cancel the other waiters.
+            file_id = await asyncio.shield(future)
+            if file_id is not None:
+                break
+            # The download failed, try to claim the track again.
+        item.results["file_id"] = file_id
+        item.done = True
+        return file_id
+
+    def update_components(self):
+        """Switch to the session's latest components if it was rebuilt.
+
+        After an expired token, the remaining tracks then use the new
+        session instead of failing one by one.
+        """
+        if self.session.created_at == self.built_at:
+            return
+        built_at = self.session.created_at
+        try:
+            components = self.session.get()
+        except SessionError:
+            return
+        self.components = components.with_profile(self.profile)
+        self.built_at = built_at
+
+    async def prepare_uncached(self, item: PipelineItem) -> PreparedTrack | None:
+        track_metadata = item.data
+        queue_progress = self.get_queue_progress(item)
+        logger.info(
+            f'({queue_progress}) Downloading "{track_metadata["attributes"]["name"]}"'
+        )
+        await self.progress.update(
+            f'({queue_progress}) Downloading "{track_metadata["attributes"]["name"]}"'
+        )
+        prepared_track = await self.pool.run(
+            prepare_track,
+            self.components,
+            self.url_info,
+            self.download_queue,
+            item.position + 1,
+            track_metadata,
+            queue_progress,
+        )
+        if prepared_track is not None:
+            await self.set_track_stage(item, "prepared")
+        return prepared_track
+
+    async def fetch(self, item: PipelineItem) -> TrackResult:
+        await self.check_quota()
+        temp_size = estimate_temp_size(item.data)
+        async with self.pool.track_slot(self.user_id, self.priority):
+            # Reserved only once the track runs, so tracks waiting for a
+            # slot do not push the running ones out of RAM.
+            temp_root = self.temp_space.reserve(temp_size)
+            track_components = self.components.with_temp_path(
+                temp_root / self.temp_name / str(item.position)
+            )
+            try:
+                result = await self.pool.run(
+                    fetch_track,
+                    track_components,
+                    self.download_queue,
+                    item.data,
+                    item.results["prepare"],
+                )
+            finally:
+                if track_components.downloader.temp_path.exists():
+                    logger.debug(
+                        f'Cleaning up "{track_components.downloader.temp_path}"'
+                    )
+                    await self.pool.run(track_components.downloader.cleanup_temp_path)
+                self.temp_space.release(temp_root, temp_size)
+        if result.final_path.exists():
+            await self.pool.run(
+                self.job_store.add_usage,
+                self.user_id,
+                result.final_path.stat().st_size,
+            )
+        await self.set_track_stage(item, "fetched")
+        await self.pool.run(
+            self.library.add,
+            *self.profile.get_cache_key(item.data["type"], item.data["id"]),
+            result,
+        )
+        return result
+
+    async def check_quota(self):
+        if not USER_DAILY_QUOTA:
+            return
+        usage = await self.pool.run(self.job_store.get_usage, self.user_id)
+        if usage >= USER_DAILY_QUOTA:
+            quota_mb = USER_DAILY_QUOTA // (1024 * 1024)
+            raise QuotaExceeded(f"Daily download quota of {quota_mb} MB reached")
+
+    async def deliver(self, item: PipelineItem):
+        track_metadata = item.data
+        if item.position in self.finished_positions:
+            return
+        try:
+            if item.error is not None:
+                raise item.error
+            if item.skipped:
+                await self.finish(item, "skipped")
+                return
+        except Exception as e:
+            await self.fail(item, e)
+            return
+        if is_video(track_metadata["type"]):
+            # Videos cannot share a media group with audio, send them alone.
+            await self.flush_uploads()
+            self.uploads.append(item)
+            await self.flush_uploads()
+            return
+        self.uploads.append(item)
+        cache_key = self.claims.get(item.position)
+        if cache_key is not None:
+            # Another job (or a later position of this one) may be waiting
+            # for this track, which must not wait for the group to fill up.
+            self.in_flight.hold(cache_key, self.request_flush)
+        if len(self.uploads) >= MEDIA_GROUP_SIZE:
+            await self.flush_uploads()
+
+    async def finish(self, item: PipelineItem, stage: str, file_id: str | None = None):
+        await self.set_track_stage(item, stage)
+        self.resolve_claim(item, file_id)
+
+    async def fail(
+        self, item: PipelineItem, exception: Exception, stage: str | None = None
+    ):
+        self.error_count += 1
+        metrics.inc(
+            "errors_total",
+            stage=stage or item.error_stage or "deliver",
+            type=type(exception).__name__,
+        )
+        self.resolve_claim(item, None)
+        await self.set_track_stage(item, "failed")
+        logger.error(
+            f'({self.get_queue_progress(item)}) Failed to download "{item.data["attributes"]["name"]}"',
+            exc_info=downloader_config.print_exceptions,
+        )
+        # Blame the components the track was prepared with: the job may
+        # have moved on to newer ones since, and those must not be rebuilt.
+        await self.pool.run(
+            self.session.handle_error,
+            exception,
+            item.results.get("built_at", self.built_at),
+        )
+
+    def resolve_claim(self, item: PipelineItem, file_id: str | None):
+        cache_key = self.claims.pop(item.position, None)
+        if cache_key is not None:
+            self.in_flight.resolve(cache_key, file_id)
+
+    def request_flush(self):
+        """Send the buffered tracks without waiting for the group to fill up."""
+        task = asyncio.create_task(self.flush_uploads())
+        self.flush_tasks.add(task)
+        task.add_done_callback(self.flush_tasks.discard)
+
+    async def flush_uploads(self):
+        async with self.upload_lock:
+            items, self.uploads = self.uploads, []
+            # A track that cannot be fitted to the upload limit fails on its
+            # own, the rest of the group is still sent.
+            ready = []
+            for item in items:
+                try:
+                    item.results["upload"] = await self.get_media(item)
+                except Exception as e:
+                    await self.fail(item, e, "upload")
+                    continue
+                ready.append(item)
+            items = ready
+            if not items:
+                return
+            try:
+                file_ids = await self.upload(items)
+            except BadRequest as e:
+                if not any("file_id" in item.results for item in items):
+                    for item in items:
+                        await self.fail(item, e, "upload")
+                    return
+                # Telegram does not say which file_id it rejected, so the
+                # tracks are sent one by one to find it.
+                logger.warning(f"Media group was rejected ({e}), sending tracks alone")
+                for item in items:
+                    await self.send_alone(item)
+                return
+            except Exception as e:
+                for item in items:
+                    await self.fail(item, e, "upload")
+                return
+            for item, file_id in zip(items, file_ids):
+                await self.finish(item, "delivered", file_id)
+
+    async def send_alone(self, item: PipelineItem):
+        """Send one track, downloading it again if its cached file_id is rejected."""
+        track_metadata = item.data
+        try:
+            if "file_id" in item.results:
+                if await self.send_file_id(
+                    track_metadata["type"],
+                    self.profile.get_cache_key(
+                        track_metadata["type"], track_metadata["id"]
+                    ),
+                    item.results["file_id"],
+                ):
+                    await self.finish(item, "delivered")
+                    return
+                item.results.clear()
+                item.results["built_at"] = self.built_at
+                prepared_track = await self.prepare_uncached(item)
+                if prepared_track is None:
+                    await self.finish(item, "skipped")
+                    return
+                item.results["prepare"] = prepared_track
+                item.results["fetch"] = await self.fetch(item)
+            item.results["upload"] = await self.get_media(item)
+            file_ids = await self.upload([item])
+        except Exception as e:
+            await self.fail(item, e, "upload")
+            return
+        await self.finish(item, "delivered", file_ids[0])
+
+    async def send_cached(
+        self, track_type: str, cache_key: tuple[str, str, int]
+    ) -> bool:
+        """Re-send a previously uploaded track, ``False`` if there is none to send."""
+        file_id = await self.pool.run(self.file_id_cache.get, *cache_key)
+        if file_id is None:
+            return False
+        return await self.send_file_id(track_type, cache_key, file_id)
+
+    async def send_file_id(
+        self, track_type: str, cache_key: tuple[str, str, int], file_id: str
+    ) -> bool:
+        try:
+            if is_video(track_type):
+                await self.limiter.call(
+                    self.chat_id,
+                    self.bot.send_video,
+                    chat_id=self.chat_id,
+                    video=file_id,
+                )
+            else:
+                await self.limiter.call(
+                    self.chat_id,
+                    self.bot.send_audio,
+                    chat_id=self.chat_id,
+                    audio=file_id,
+                )
+        except BadRequest as e:
+            logger.warning(f"Cached file_id was rejected ({e}), downloading again")
+            await self.pool.run(self.file_id_cache.invalidate, *cache_key)
+            return False
+        return True
+
+    async def upload(self, items: list[PipelineItem]) -> list[str | None]:
+        """Send tracks to the chat and return their ``file_id``s.
+
+        Several tracks go out as one media group, a single one as a plain
+        audio or video message since a media group needs at least two.
+        What is sent is ``item.results["upload"]``, from ``get_media``.
+        """
+        media = [item.results["upload"] for item in items]
+        thumbnails = [
+            None if "file_id" in item.results else await self.get_thumbnail(item.data)
+            for item in items
+        ]
+        for path in media:
+            if isinstance(path, Path):
+                metrics.inc("bytes_total", path.stat().st_size, stage="upload")
+        if len(items) == 1:
+            messages = [await self.send_single(items[0], media[0], thumbnails[0])]
+        else:
+            messages = await self.limiter.call(
+                self.chat_id,
+                self.bot.send_media_group,
+                chat_id=self.chat_id,
+                media=[
+                    InputMediaAudio(
+                        media=item_media,
+                        title=item.data["attributes"]["name"],
+                        performer=item.data["attributes"]["artistName"],
+                        thumbnail=thumbnail,
+                    )
+                    for item, item_media, thumbnail in zip(items, media, thumbnails)
+                ],
+            )
+        file_ids = []
+        for item, message in zip(items, messages):
+            attachment = message.effective_attachment
+            if attachment is None:
+                file_ids.append(None)
+                continue
+            if "file_id" in item.results:
+                file_ids.append(attachment.file_id)
+                continue
+            await self.pool.run(
+                self.file_id_cache.set,
+                *self.profile.get_cache_key(item.data["type"], item.data["id"]),
+                attachment.file_id,
+            )
+            file_ids.append(attachment.file_id)
+        return file_ids
+
+    async def send_single(
+        self, item: PipelineItem, media: Path | str, thumbnail: bytes | None
+    ) -> Message:
+        track_metadata = item.data
+        if is_video(track_metadata["type"]):
+            return await self.limiter.call(
+                self.chat_id,
+                self.bot.send_video,
+                chat_id=self.chat_id,
+                caption=f'{track_metadata["attributes"]["artistName"]} - {track_metadata["attributes"]["name"]}',
+                thumbnail=thumbnail,
+                video=media,
+                supports_streaming=True,
+            )
+        return await self.limiter.call(
+            self.chat_id,
+            self.bot.send_audio,
+            chat_id=self.chat_id,
+            title=track_metadata["attributes"]["name"],
+            performer=track_metadata["attributes"]["artistName"],
+            thumbnail=thumbnail,
+            audio=media,
+        )
+
+    async def get_thumbnail(self, track_metadata: dict) -> bytes | None:
+        """The pre-sized cover Telegram shows next to the track, if available."""
+        try:
+            return await self.pool.run(
+                self.components.artwork.get_thumbnail,
+                self.components.downloader.get_cover_url(track_metadata),
+            )
+        except Exception as e:
+            logger.debug(f"Could not get thumbnail: {e}")
+            return None
+
+    async def get_media(self, item: PipelineItem) -> Path | str:
+        """What to send for the track: its cached file_id, or its file."""
+        # Tracks that were sent before go out by file_id, in the same group.
+        return item.results.get("file_id") or await self.get_upload_path(item)
+
+    async def get_upload_path(self, item: PipelineItem) -> Path:
+        """The track's file, re-encoded first if it is over the upload limit."""
+        result: TrackResult = item.results["fetch"]
+        video = is_video(item.data["type"])
+        return await self.pool.run(
+            fit_to_size,
+            self.components.downloader.ffmpeg_path_full
+            or downloader_config.ffmpeg_path,
+            result.final_path,
+            self.temp_path / "upload" / f"{item.position}{'.mp4' if video else '.m4a'}",
+            item.data,
+            UPLOAD_SIZE_LIMIT,
+            video,
+        )
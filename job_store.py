@@ -0,0 +1,249 @@
+from __future__ import annotations
+import logging
+import threading
+import time
+import typing
+from dataclasses import dataclass
+from pathlib import Path
+from config import JOB_STORE_PATH, JOB_STORE_RETENTION
+from sqlite_store import connect
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class JobRecord:
+    id: int
+    chat_id: int
+    user_id: int
+    message_id: int | None
+    url: str
+    url_progress: str
+    profile: str | None = None
+
+
+class JobStore:
+    """Durable record of URL jobs and the stage each of their tracks reached.
+
+    Jobs are written before any work starts, so after a restart every job
+    that did not finish can be picked up again, skipping the tracks that
+    were already delivered. In worker mode the table doubles as the queue
+    the worker processes claim jobs from.
+    """
+
+    # Stages after which a track never needs to be processed again.
+    FINAL_STAGES = ("delivered", "skipped")
+
+    def __init__(
+        self,
+        path: Path = JOB_STORE_PATH,
+        retention: int = JOB_STORE_RETENTION,
+    ):
+        self.path = path
+        self.retention = retention
+        self._lock = threading.Lock()
+        self.connection = connect(path)
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER, "
+                "user_id INTEGER, message_id INTEGER, url TEXT, url_progress TEXT, "
+                "status TEXT, created_at REAL, updated_at REAL)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS tracks ("
+                "job_id INTEGER, position INTEGER, track_id TEXT, stage TEXT, "
+                "updated_at REAL, PRIMARY KEY (job_id, position))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)"
+            )
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                "user_id INTEGER, day TEXT, bytes INTEGER, "
+                "PRIMARY KEY (user_id, day))"
+            )
+            columns = {
+                row[1] for row in self.connection.execute("PRAGMA table_info(jobs)")
+            }
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS chat_profiles ("
+                "chat_id INTEGER PRIMARY KEY, profile TEXT)"
+            )
+            for name, column_type in (
+                ("worker", "TEXT"),
+                ("heartbeat_at", "REAL"),
+                ("profile", "TEXT"),
+            ):
+                if name not in columns:
+                    self.connection.execute(
+                        f"ALTER TABLE jobs ADD COLUMN {name} {column_type}"
+                    )
+
+    def add_job(
+        self,
+        chat_id: int,
+        user_id: int,
+        message_id: int | None,
+        url: str,
+        url_progress: str,
+        profile: str | None = None,
+    ) -> JobRecord:
+        now = time.time()
+        with self._lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (chat_id, user_id, message_id, url, url_progress, "
+                "profile, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (chat_id, user_id, message_id, url, url_progress, profile, now, now),
+            )
+        return JobRecord(
+            cursor.lastrowid, chat_id, user_id, message_id, url, url_progress, profile
+        )
+
+    def set_job_status(self, job_id: int, status: str):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, updated_at = ? WHERE id = ?",
+                (status, time.time(), job_id),
+            )
+
+    def get_unfinished_jobs(self) -> list[JobRecord]:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT id, chat_id, user_id, message_id, url, url_progress, "
+                "profile FROM jobs WHERE status IN ('queued', 'running') ORDER BY id"
+            ).fetchall()
+        return [JobRecord(*row) for row in rows]
+
+    def claim_job(
+        self, worker_id: str, lease: float, exclude_users: typing.Collection[int] = ()
+    ) -> JobRecord | None:
+        """Hand the oldest waiting job to ``worker_id``.
+
+        Running jobs whose worker sent no heartbeat for ``lease`` seconds
+        are taken over as well, so a crashed worker loses no work. Jobs of
+        ``exclude_users`` are left for other workers.
+        """
+        now = time.time()
+        placeholders = ", ".join("?" for _ in exclude_users)
+        with self._lock, self.connection:
+            row = self.connection.execute(
+                "UPDATE jobs SET status = 'running', worker = ?, heartbeat_at = ?, "
+                "updated_at = ? WHERE id = (SELECT id FROM jobs "
+                "WHERE (status = 'queued' OR (status = 'running' "
+                "AND COALESCE(heartbeat_at, 0) < ?)) "
+                f"AND user_id NOT IN ({placeholders}) ORDER BY id LIMIT 1) "
+                "RETURNING id, chat_id, user_id, message_id, url, url_progress, profile",
+                (worker_id, now, now, now - lease, *exclude_users),
+            ).fetchone()
+        return JobRecord(*row) if row is not None else None
+
+    def heartbeat(self, worker_id: str):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE jobs SET heartbeat_at = ? "
+                "WHERE worker = ? AND status = 'running'",
+                (time.time(), worker_id),
+            )
+
+    def count_unfinished_jobs(self) -> dict[str, int]:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT status, COUNT(*) FROM jobs "
+                "WHERE status IN ('queued', 'running') GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+    def set_chat_profile(self, chat_id: int, profile: str):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO chat_profiles (chat_id, profile) VALUES (?, ?)",
+                (chat_id, profile),
+            )
+
+    def get_chat_profile(self, chat_id: int) -> str | None:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT profile FROM chat_profiles WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def add_tracks(self, job_id: int, track_ids: list[str]):
+        """Register the job's tracks, keeping the stage of tracks seen before."""
+        now = time.time()
+        with self._lock, self.connection:
+            self.connection.executemany(
+                "INSERT INTO tracks (job_id, position, track_id, stage, updated_at) "
+                "VALUES (?, ?, ?, 'pending', ?) "
+                "ON CONFLICT (job_id, position) DO UPDATE SET "
+                "track_id = excluded.track_id, "
+                "stage = CASE WHEN tracks.track_id = excluded.track_id "
+                "THEN tracks.stage ELSE 'pending' END",
+                [
+                    (job_id, position, track_id, now)
+                    for position, track_id in enumerate(track_ids)
+                ],
+            )
+
+    def get_finished_positions(self, job_id: int) -> set[int]:
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT position FROM tracks WHERE job_id = ? AND stage IN (?, ?)",
+                (job_id, *self.FINAL_STAGES),
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def set_track_stage(self, job_id: int, position: int, stage: str):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "UPDATE tracks SET stage = ?, updated_at = ? "
+                "WHERE job_id = ? AND position = ?",
+                (stage, time.time(), job_id, position),
+            )
+
+    def add_usage(self, user_id: int, size: int):
+        """Count ``size`` downloaded bytes against the user's daily quota."""
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO usage (user_id, day, bytes) VALUES (?, ?, ?) "
+                "ON CONFLICT (user_id, day) DO UPDATE SET "
+                "bytes = usage.bytes + excluded.bytes",
+                (user_id, self._get_day(), size),
+            )
+
+    def get_usage(self, user_id: int) -> int:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT bytes FROM usage WHERE user_id = ? AND day = ?",
+                (user_id, self._get_day()),
+            ).fetchone()
+        return row[0] if row is not None else 0
+
+    @staticmethod
+    def _get_day() -> str:
+        return time.strftime("%Y-%m-%d", time.gmtime())
+
+    def purge(self):
+        """Forget finished jobs older than the retention period."""
+        cutoff = time.time() - self.retention
+        with self._lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM tracks WHERE job_id IN (SELECT id FROM jobs "
+                "WHERE status NOT IN ('queued', 'running') AND updated_at < ?)",
+                (cutoff,),
+            )
+            self.connection.execute(
+                "DELETE FROM jobs "
+                "WHERE status NOT IN ('queued', 'running') AND updated_at < ?",
+                (cutoff,),
+            )
+            self.connection.execute(
+                "DELETE FROM usage WHERE day < ?", (self._get_day(),)
+            )
+
+    def close(self):
+        self.connection.close()
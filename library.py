@@ -0,0 +1,211 @@
+from __future__ import annotations
+import hashlib
+import logging
+import threading
+import time
+from pathlib import Path
+from config import LIBRARY_INDEX_PATH, LIBRARY_BUDGET
+from download import TrackResult
+from sqlite_store import connect
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LibraryIndex:
+    """Index of the tracks kept in the output directory, stored in SQLite.
+
+    Entries are keyed like the ``file_id`` cache, so a track that is still
+    on disk is sent again without being downloaded. Once the indexed files
+    exceed ``budget`` bytes, the least recently used ones are deleted.
+    """
+
+    def __init__(
+        self,
+        output_path: Path,
+        path: Path = LIBRARY_INDEX_PATH,
+        budget: int = LIBRARY_BUDGET,
+    ):
+        self.output_path = output_path.resolve()
+        self.path = path
+        self.budget = budget
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self.connection = connect(path)
+        self._create_tables()
+
+    def _create_tables(self):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "track_id TEXT, codec TEXT, cover_size INTEGER, path TEXT, "
+                "cover_path TEXT, size INTEGER, mtime REAL, hash TEXT, "
+                "last_access REAL, PRIMARY KEY (track_id, codec, cover_size))"
+            )
+            self.connection.execute(
+                "CREATE INDEX IF NOT EXISTS files_last_access ON files (last_access)"
+            )
+
+    def get(self, track_id: str, codec: str, cover_size: int) -> TrackResult | None:
+        """Return the indexed files of a track if they are still intact on disk."""
+        with self._lock, self.connection:
+            row = self.connection.execute(
+                "SELECT path, cover_path, size, mtime FROM files "
+                "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                (track_id, codec, cover_size),
+            ).fetchone()
+            if row is not None and not self._is_intact(Path(row[0]), row[2], row[3]):
+                self.connection.execute(
+                    "DELETE FROM files "
+                    "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                    (track_id, codec, cover_size),
+                )
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.connection.execute(
+                "UPDATE files SET last_access = ? "
+                "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                (time.time(), track_id, codec, cover_size),
+            )
+            self.hits += 1
+            return TrackResult(Path(row[0]), Path(row[1]))
+
+    def add(self, track_id: str, codec: str, cover_size: int, result: TrackResult):
+        if not result.final_path.exists():
+            return
+        stat = result.final_path.stat()
+        file_hash = hash_file(result.final_path)
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO files (track_id, codec, cover_size, path, "
+                "cover_path, size, mtime, hash, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    track_id,
+                    codec,
+                    cover_size,
+                    str(result.final_path.resolve()),
+                    str(result.cover_path.resolve()),
+                    stat.st_size,
+                    stat.st_mtime,
+                    file_hash,
+                    time.time(),
+                ),
+            )
+        self.evict(keep=(track_id, codec, cover_size))
+
+    def evict(self, keep: tuple[str, str, int] | None = None):
+        """Delete least recently used files until the library fits the budget."""
+        if not self.budget:
+            return
+        with self._lock, self.connection:
+            total = self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM files"
+            ).fetchone()[0]
+            if total <= self.budget:
+                return
+            rows = self.connection.execute(
+                "SELECT track_id, codec, cover_size, path, cover_path, size "
+                "FROM files ORDER BY last_access"
+            ).fetchall()
+            for track_id, codec, cover_size, path, cover_path, size in rows:
+                if total <= self.budget:
+                    break
+                if (track_id, codec, cover_size) == keep:
+                    continue
+                self.connection.execute(
+                    "DELETE FROM files "
+                    "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                    (track_id, codec, cover_size),
+                )
+                if not self.connection.execute(
+                    "SELECT 1 FROM files WHERE path = ? LIMIT 1", (path,)
+                ).fetchone():
+                    self._delete(Path(path))
+                # Covers are shared by every track of an album.
+                if not self.connection.execute(
+                    "SELECT 1 FROM files WHERE cover_path = ? LIMIT 1",
+                    (cover_path,),
+                ).fetchone():
+                    self._delete(Path(cover_path))
+                total -= size
+                self.evictions += 1
+                logger.debug(f'Evicted "{path}" from the library')
+
+    def sync(self):
+        """Check the indexed files against the disk, without walking the output tree.
+
+        Missing files are dropped and changed ones re-hashed, so a restart
+        only costs one ``stat`` per indexed file.
+        """
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT track_id, codec, cover_size, path, mtime FROM files"
+            ).fetchall()
+        removed = updated = 0
+        for track_id, codec, cover_size, path, mtime in rows:
+            key = (track_id, codec, cover_size)
+            try:
+                stat = Path(path).stat()
+            except OSError:
+                with self._lock, self.connection:
+                    self.connection.execute(
+                        "DELETE FROM files "
+                        "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                        key,
+                    )
+                removed += 1
+                continue
+            if stat.st_mtime == mtime:
+                continue
+            file_hash = hash_file(Path(path))
+            with self._lock, self.connection:
+                self.connection.execute(
+                    "UPDATE files SET size = ?, mtime = ?, hash = ? "
+                    "WHERE track_id = ? AND codec = ? AND cover_size = ?",
+                    (stat.st_size, stat.st_mtime, file_hash, *key),
+                )
+            updated += 1
+        if removed or updated:
+            logger.info(
+                f"Library index synced ({removed} removed, {updated} updated)"
+            )
+        self.evict()
+
+    def get_size(self) -> int:
+        with self._lock:
+            return self.connection.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM files"
+            ).fetchone()[0]
+
+    def _is_intact(self, path: Path, size: int, mtime: float) -> bool:
+        try:
+            stat = path.stat()
+        except OSError:
+            return False
+        return stat.st_size == size and stat.st_mtime == mtime
+
+    def _delete(self, path: Path):
+        path.unlink(missing_ok=True)
+        # Drop the album and artist folders once they are empty.
+        parent = path.parent
+        while parent != self.output_path and self.output_path in parent.parents:
+            try:
+                parent.rmdir()
+            except OSError:
+                break
+            parent = parent.parent
+
+    def close(self):
+        self.connection.close()
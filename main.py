@@ -1,530 +1,443 @@
 from __future__ import annotations
+import asyncio
+import hashlib
 import logging
-import inspect
-from pathlib import Path
 import re
-from telegram import Update
-from telegram.ext import ApplicationBuilder, MessageHandler, CallbackContext, filters
-from gamdl.apple_music_api import AppleMusicApi
-from gamdl.constants import X_NOT_FOUND_STRING, LEGACY_CODECS
-from gamdl.downloader import Downloader
-from gamdl.downloader_music_video import DownloaderMusicVideo
-from gamdl.downloader_post import DownloaderPost
-from gamdl.downloader_song import DownloaderSong
-from gamdl.downloader_song_legacy import DownloaderSongLegacy
-from gamdl.enums import (
-    CoverFormat,
-    DownloadMode,
-    MusicVideoCodec,
-    PostQuality,
-    RemuxMode,
-    SongCodec,
-    SyncedLyricsFormat,
+import signal
+import time
+import typing
+from collections import Counter
+
+# Taken before the other imports so the startup report includes them.
+started_at = time.monotonic()
+
+from telegram import Bot, Update
+from telegram.ext import (
+    Application,
+    ApplicationBuilder,
+    CallbackContext,
+    CommandHandler,
+    MessageHandler,
+    filters,
+)
+from config import (
+    TELEGRAM_TOKEN,
+    TELEGRAM_ADMIN_ID,
+    SESSION_CHECK_INTERVAL,
+    MAX_CONCURRENT_UPDATES,
+    TELEGRAM_API_URL,
+    METRICS_PORT,
+    WEBHOOK_URL,
+    WEBHOOK_LISTEN,
+    WEBHOOK_PORT,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    MODE,
+    WORKER_ID,
+    WORKER_LEASE,
+    WORKER_POLL_INTERVAL,
+    DEFAULT_PROFILE,
 )
-from gamdl.itunes_api import ItunesApi
-from config import TELEGRAM_TOKEN, TELEGRAM_ADMIN_ID
+from delivery import TelegramLimiter
+from job_store import JobRecord, JobStore
+from profiles import PROFILES
+from scheduler import FairGate, get_priority
+from metrics import metrics
+
+if typing.TYPE_CHECKING:
+    from coalesce import InFlightTracks
+    from file_cache import FileIdCache
+    from library import LibraryIndex
+    from pool import WorkerPool
+    from session import DownloaderSession
+    from temp_space import TempSpace
+
+logger = logging.getLogger(__name__)
 
-apple_music_api_sig = inspect.signature(AppleMusicApi.__init__)
-downloader_sig = inspect.signature(Downloader.__init__)
-downloader_song_sig = inspect.signature(DownloaderSong.__init__)
-downloader_music_video_sig = inspect.signature(DownloaderMusicVideo.__init__)
-downloader_post_sig = inspect.signature(DownloaderPost.__init__)
+imported_at = time.monotonic()
 
 
 async def main(update: Update, context: CallbackContext):
-    chat_id = update.message.chat_id
     user_id = update.message.from_user.id
 
+    limiter: TelegramLimiter = context.bot_data["telegram_limiter"]
     if user_id not in TELEGRAM_ADMIN_ID:
-        return await update.message.reply_text("You are not authorized!")
+        return await limiter.call(
+            update.message.chat_id,
+            update.message.reply_text,
+            "You are not authorized!",
+        )
 
     message_text = update.message.text
     url_regex = r"http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\\(\\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+"  # Regular expression for URLs
     urls: list[str] = re.findall(url_regex, message_text)
     if len(urls) <= 0:
         return
-    disable_music_video_skip: bool = True
-    save_cover: bool = True
-    overwrite: bool = True
-    save_playlist: bool = False
-    synced_lyrics_only: bool = False
-    no_synced_lyrics: bool = False
-    log_level: str = "INFO"
-    print_exceptions: bool = True
-    cookies_path: Path = Path("./data/cookies.txt").resolve()
-    language: str = apple_music_api_sig.parameters["language"].default
-    output_path: Path = downloader_sig.parameters["output_path"].default
-    temp_path: Path = downloader_sig.parameters["temp_path"].default
-    wvd_path: Path = downloader_sig.parameters["wvd_path"].default
-    nm3u8dlre_path: str = downloader_sig.parameters["nm3u8dlre_path"].default
-    mp4decrypt_path: str = downloader_sig.parameters["mp4decrypt_path"].default
-    ffmpeg_path: str = downloader_sig.parameters["ffmpeg_path"].default
-    mp4box_path: str = downloader_sig.parameters["mp4box_path"].default
-    download_mode: DownloadMode = DownloadMode.YTDLP
-    remux_mode: RemuxMode = downloader_sig.parameters["remux_mode"].default
-    cover_format: CoverFormat = downloader_sig.parameters["cover_format"].default
-    template_folder_album: str = downloader_sig.parameters[
-        "template_folder_album"
-    ].default
-    template_folder_compilation: str = downloader_sig.parameters[
-        "template_folder_compilation"
-    ].default
-    template_file_single_disc: str = downloader_sig.parameters[
-        "template_file_single_disc"
-    ].default
-    template_file_multi_disc: str = downloader_sig.parameters[
-        "template_file_multi_disc"
-    ].default
-    template_folder_no_album: str = downloader_sig.parameters[
-        "template_folder_no_album"
-    ].default
-    template_file_no_album: str = downloader_sig.parameters[
-        "template_file_no_album"
-    ].default
-    template_file_playlist: str = downloader_sig.parameters[
-        "template_file_playlist"
-    ].default
-    template_date: str = downloader_sig.parameters["template_date"].default
-    exclude_tags: str = downloader_sig.parameters["exclude_tags"].default
-    cover_size: int = 320
-    truncate: int = downloader_sig.parameters["truncate"].default
-    codec_song: SongCodec = downloader_song_sig.parameters["codec"].default
-    synced_lyrics_format: SyncedLyricsFormat = downloader_song_sig.parameters[
-        "synced_lyrics_format"
-    ].default
-    codec_music_video: MusicVideoCodec = downloader_music_video_sig.parameters[
-        "codec"
-    ].default
-    quality_post: PostQuality = downloader_post_sig.parameters["quality"].default
-
-    logging.basicConfig(
-        format="[%(levelname)-8s %(asctime)s] %(message)s",
-        datefmt="%H:%M:%S",
+    job_store: JobStore = context.bot_data["job_store"]
+    # A profile name anywhere in the message, like "fast", overrides the
+    # one chosen for the chat with /profile.
+    profile = next(
+        (word for word in message_text.lower().split() if word in PROFILES), None
     )
-    logger = logging.getLogger(__name__)
-    logger.setLevel(log_level)
-    logger.debug("Starting downloader")
-    if not cookies_path.exists():
-        logger.critical(X_NOT_FOUND_STRING.format("Cookies file", cookies_path))
+    if profile is None:
+        profile = await asyncio.to_thread(
+            job_store.get_chat_profile, update.message.chat_id
+        )
+    records = [
+        await asyncio.to_thread(
+            job_store.add_job,
+            update.message.chat_id,
+            user_id,
+            update.message.message_id,
+            url,
+            f"URL {url_index}/{len(urls)}",
+            profile,
+        )
+        for url_index, url in enumerate(urls, start=1)
+    ]
+    if MODE == "bot":
+        # A worker process claims the jobs from the job store.
         return
-    apple_music_api = AppleMusicApi(
-        cookies_path,
-        language=language,
-    )
-    itunes_api = ItunesApi(
-        apple_music_api.storefront,
-        apple_music_api.language,
-    )
-    downloader = Downloader(
-        apple_music_api,
-        itunes_api,
-        output_path,
-        temp_path,
-        wvd_path,
-        nm3u8dlre_path,
-        mp4decrypt_path,
-        ffmpeg_path,
-        mp4box_path,
-        download_mode,
-        remux_mode,
-        cover_format,
-        template_folder_album,
-        template_folder_compilation,
-        template_file_single_disc,
-        template_file_multi_disc,
-        template_folder_no_album,
-        template_file_no_album,
-        template_file_playlist,
-        template_date,
-        exclude_tags,
-        cover_size,
-        truncate,
-    )
-    downloader_song = DownloaderSong(
-        downloader,
-        codec_song,
-        synced_lyrics_format,
-    )
-    downloader_song_legacy = DownloaderSongLegacy(
-        downloader,
-        codec_song,
-    )
-    downloader_music_video = DownloaderMusicVideo(
-        downloader,
-        codec_music_video,
-    )
-    downloader_post = DownloaderPost(
-        downloader,
-        quality_post,
-    )
-    if not synced_lyrics_only:
-        if wvd_path and not wvd_path.exists():
-            logger.critical(X_NOT_FOUND_STRING.format(".wvd file", wvd_path))
-            return
-        logger.debug("Setting up CDM")
-        downloader.set_cdm()
-        if not downloader.ffmpeg_path_full and (
-            remux_mode == RemuxMode.FFMPEG or download_mode == DownloadMode.NM3U8DLRE
-        ):
-            logger.critical(X_NOT_FOUND_STRING.format("ffmpeg", ffmpeg_path))
-            return
-        if not downloader.mp4box_path_full and remux_mode == RemuxMode.MP4BOX:
-            logger.critical(X_NOT_FOUND_STRING.format("MP4Box", mp4box_path))
-            return
-        if (
-            not downloader.mp4decrypt_path_full
-            and codec_song
-            not in (
-                SongCodec.AAC_LEGACY,
-                SongCodec.AAC_HE_LEGACY,
-            )
-            or (remux_mode == RemuxMode.MP4BOX and not downloader.mp4decrypt_path_full)
-        ):
-            logger.critical(X_NOT_FOUND_STRING.format("mp4decrypt", mp4decrypt_path))
-            return
-        if (
-            download_mode == DownloadMode.NM3U8DLRE
-            and not downloader.nm3u8dlre_path_full
-        ):
-            logger.critical(X_NOT_FOUND_STRING.format("N_m3u8DL-RE", nm3u8dlre_path))
-            return
-        if not downloader.mp4decrypt_path_full:
-            logger.warn(
-                X_NOT_FOUND_STRING.format("mp4decrypt", mp4decrypt_path)
-                + ", music videos will not be downloaded"
-            )
-            skip_mv = True
-        else:
-            skip_mv = False
-        if codec_song not in LEGACY_CODECS:
-            logger.warn(
-                "You have chosen a non-legacy codec. Support for non-legacy codecs are not guaranteed, "
-                "as most of the songs cannot be downloaded when using non-legacy codecs."
-            )
     error_count = 0
-    for url_index, url in enumerate(urls, start=1):
-        url_progress = f"URL {url_index}/{len(urls)}"
+    for record in records:
+        error_count += await run_job(context.bot, context.bot_data, record)
+    logger.info(f"Done ({error_count} error(s))")
+
+
+async def run_job(bot: Bot, bot_data: dict, record: JobRecord) -> int:
+    from job import DownloadJob
+    from session import SessionError
+
+    session: DownloaderSession = bot_data["session"]
+    pool: WorkerPool = bot_data["pool"]
+    async with pool.slot(record.user_id, get_priority(record.url)):
+        # Shielded so a cancelled job does not cancel the build for the others.
+        await asyncio.shield(bot_data["session_build"])
         try:
-            logger.info(f'({url_progress}) Checking "{url}"')
-            url_info = downloader.get_url_info(url)
-            download_queue = downloader.get_download_queue(url_info)
-            download_queue_tracks_metadata = download_queue.tracks_metadata
-        except Exception as e:
-            error_count += 1
-            logger.error(
-                f'({url_progress}) Failed to check "{url}"',
-                exc_info=print_exceptions,
+            components = session.get()
+        except SessionError as e:
+            logger.critical(str(e))
+            job_store: JobStore = bot_data["job_store"]
+            await asyncio.to_thread(job_store.set_job_status, record.id, "failed")
+            limiter: TelegramLimiter = bot_data["telegram_limiter"]
+            await limiter.call(
+                record.chat_id,
+                bot.send_message,
+                chat_id=record.chat_id,
+                text="Downloader is not ready, try again later",
+                reply_to_message_id=record.message_id,
             )
-            continue
-        for download_index, track_metadata in enumerate(
-            download_queue_tracks_metadata, start=1
-        ):
-            queue_progress = f"Track {download_index}/{len(download_queue_tracks_metadata)} from URL {url_index}/{len(urls)}"
+            return 1
+        return await DownloadJob(bot, bot_data, components, record).run()
+
+
+async def resume_jobs(app: Application):
+    job_store: JobStore = app.bot_data["job_store"]
+    records = await asyncio.to_thread(job_store.get_unfinished_jobs)
+    if records:
+        logger.info(f"Resuming {len(records)} unfinished job(s)")
+    await asyncio.gather(
+        *(run_job(app.bot, app.bot_data, record) for record in records),
+        return_exceptions=True,
+    )
+
+
+async def set_profile(update: Update, context: CallbackContext):
+    limiter: TelegramLimiter = context.bot_data["telegram_limiter"]
+    if update.message.from_user.id not in TELEGRAM_ADMIN_ID:
+        return await limiter.call(
+            update.message.chat_id,
+            update.message.reply_text,
+            "You are not authorized!",
+        )
+    job_store: JobStore = context.bot_data["job_store"]
+    if context.args and context.args[0].lower() in PROFILES:
+        profile = context.args[0].lower()
+        await asyncio.to_thread(
+            job_store.set_chat_profile, update.message.chat_id, profile
+        )
+        text = f"Profile set to {profile}"
+    else:
+        profile = await asyncio.to_thread(
+            job_store.get_chat_profile, update.message.chat_id
+        )
+        text = (
+            f"Profile: {profile or DEFAULT_PROFILE}\n"
+            f"Available: {', '.join(PROFILES)}"
+        )
+    await limiter.call(update.message.chat_id, update.message.reply_text, text)
+
+
+async def health(update: Update, context: CallbackContext):
+    limiter: TelegramLimiter = context.bot_data["telegram_limiter"]
+    if update.message.from_user.id not in TELEGRAM_ADMIN_ID:
+        return await limiter.call(
+            update.message.chat_id,
+            update.message.reply_text,
+            "You are not authorized!",
+        )
+    if MODE == "bot":
+        job_store: JobStore = context.bot_data["job_store"]
+        jobs = await asyncio.to_thread(job_store.count_unfinished_jobs)
+        return await limiter.call(
+            update.message.chat_id,
+            update.message.reply_text,
+            f"queued_jobs: {jobs.get('queued', 0)}\n"
+            f"running_jobs: {jobs.get('running', 0)}",
+        )
+    session: DownloaderSession = context.bot_data["session"]
+    pool: WorkerPool = context.bot_data["pool"]
+    in_flight: InFlightTracks = context.bot_data["in_flight"]
+    temp_space: TempSpace = context.bot_data["temp_space"]
+    library: LibraryIndex = context.bot_data["library"]
+    status = {
+        **session.health(),
+        "active_jobs": pool.active_jobs,
+        "waiting_jobs": pool.jobs.waiting,
+        "active_tracks": pool.tracks.active,
+        "waiting_tracks": pool.tracks.waiting,
+        "in_flight_tracks": len(in_flight),
+        "coalesced_tracks": in_flight.coalesced,
+        "telegram_retries": limiter.retries,
+        "temp_ram_reserved": temp_space.reserved,
+        "temp_ram_spills": temp_space.spills,
+        "library_size": await asyncio.to_thread(library.get_size),
+        "library_hits": library.hits,
+        "library_evictions": library.evictions,
+    }
+    await limiter.call(
+        update.message.chat_id,
+        update.message.reply_text,
+        "\n".join(f"{key}: {value}" for key, value in status.items()),
+    )
+
+
+async def refresh_session(session: DownloaderSession, session_build: asyncio.Task):
+    await asyncio.shield(session_build)
+    while True:
+        await asyncio.sleep(SESSION_CHECK_INTERVAL)
+        await asyncio.to_thread(session.refresh_if_stale)
+
+
+async def build_session(session: DownloaderSession):
+    with metrics.timer("startup_session"):
+        await asyncio.to_thread(session.refresh)
+    time_to_ready = time.monotonic() - started_at
+    metrics.gauge("time_to_ready_seconds", lambda: time_to_ready)
+    logger.info(f"Ready {time_to_ready:.2f}s after start")
+
+
+async def post_init(app: Application):
+    metrics.observe("startup_imports", imported_at - started_at)
+    init_started_at = time.monotonic()
+    app.bot_data["telegram_limiter"] = TelegramLimiter()
+    job_store = JobStore()
+    await asyncio.to_thread(job_store.purge)
+    app.bot_data["job_store"] = job_store
+    if MODE == "bot":
+        metrics.observe("startup_init", time.monotonic() - init_started_at)
+        return
+    # Only imported where tracks are downloaded, so the bot process never
+    # loads gamdl's API clients, mutagen or requests. It still loads
+    # gamdl.enums through profiles, for the profile names.
+    from api_cache import ApiCache
+    from artwork import ArtworkCache
+    from coalesce import InFlightTracks
+    from file_cache import FileIdCache
+    from library import LibraryIndex
+    from pool import WorkerPool
+    from session import DownloaderSession, downloader_config
+    from temp_space import TempSpace
+
+    session = DownloaderSession(ApiCache(), ArtworkCache())
+    app.bot_data["session"] = session
+    # gamdl is loaded and the tools are looked up in the background, so
+    # updates are accepted meanwhile. Jobs wait for it in run_job.
+    app.bot_data["session_build"] = asyncio.create_task(build_session(session))
+    app.bot_data["pool"] = WorkerPool()
+    app.bot_data["file_id_cache"] = FileIdCache(str(app.bot.id))
+    app.bot_data["in_flight"] = InFlightTracks()
+    app.bot_data["temp_space"] = TempSpace(downloader_config.temp_path)
+    library = LibraryIndex(downloader_config.output_path)
+    await asyncio.to_thread(library.sync)
+    app.bot_data["library"] = library
+    register_gauges(app.bot_data)
+    if METRICS_PORT:
+        try:
+            app.bot_data["metrics_server"] = await metrics.serve()
+        except OSError as e:
+            # Typically a second worker on the same host, which needs its
+            # own METRICS_PORT. Downloading does not depend on it.
+            logger.warning(f"Not serving metrics on port {METRICS_PORT}: {e}")
+    # Not app.create_task: Application.stop() waits for those, and this
+    # loop never ends on its own.
+    app.bot_data["refresh_task"] = asyncio.create_task(
+        refresh_session(session, app.bot_data["session_build"])
+    )
+    if MODE == "all":
+        # Workers claim unfinished jobs from the job store on their own.
+        app.create_task(resume_jobs(app))
+    metrics.observe("startup_init", time.monotonic() - init_started_at)
+
+
+def register_gauges(bot_data: dict):
+    session: DownloaderSession = bot_data["session"]
+    pool: WorkerPool = bot_data["pool"]
+    file_id_cache: FileIdCache = bot_data["file_id_cache"]
+    in_flight: InFlightTracks = bot_data["in_flight"]
+    temp_space: TempSpace = bot_data["temp_space"]
+    library: LibraryIndex = bot_data["library"]
+    metrics.gauge("active_jobs", lambda: pool.active_jobs)
+    metrics.gauge("worker_queue_depth", lambda: pool.queued_calls)
+    metrics.gauge("waiting_jobs", lambda: pool.jobs.waiting)
+    metrics.gauge("active_tracks", lambda: pool.tracks.active)
+    metrics.gauge("waiting_tracks", lambda: pool.tracks.waiting)
+    metrics.gauge("in_flight_tracks", lambda: len(in_flight))
+    metrics.gauge("coalesced_tracks", lambda: in_flight.coalesced)
+    metrics.gauge("api_cache_hits", lambda: session.cache.hits)
+    metrics.gauge("api_cache_misses", lambda: session.cache.misses)
+    metrics.gauge("file_id_cache_hits", lambda: file_id_cache.hits)
+    metrics.gauge("file_id_cache_misses", lambda: file_id_cache.misses)
+    metrics.gauge("library_hits", lambda: library.hits)
+    metrics.gauge("library_misses", lambda: library.misses)
+    metrics.gauge("library_evictions", lambda: library.evictions)
+    metrics.gauge("artwork_cache_hits", lambda: session.artwork.hits)
+    metrics.gauge("artwork_cache_misses", lambda: session.artwork.misses)
+    metrics.gauge("artwork_cache_evictions", lambda: session.artwork.evictions)
+    metrics.gauge("temp_ram_reserved_bytes", lambda: temp_space.reserved)
+    metrics.gauge("temp_ram_spills", lambda: temp_space.spills)
+
+
+async def post_stop(app: Application):
+    # By now Application.stop() has waited for every update being handled,
+    # so the jobs they started have finished.
+    if "refresh_task" in app.bot_data:
+        app.bot_data["refresh_task"].cancel()
+    logger.info("All in-flight jobs drained")
+
+
+async def post_shutdown(app: Application):
+    app.bot_data["job_store"].close()
+    if MODE == "bot":
+        return
+    if "metrics_server" in app.bot_data:
+        app.bot_data["metrics_server"].close()
+    app.bot_data["pool"].shutdown()
+    app.bot_data["session"].cache.close()
+    app.bot_data["file_id_cache"].close()
+    app.bot_data["library"].close()
+
+
+async def send_heartbeats(job_store: JobStore):
+    while True:
+        await asyncio.to_thread(job_store.heartbeat, WORKER_ID)
+        await asyncio.sleep(WORKER_LEASE / 3)
+
+
+async def run_worker(app: Application):
+    """Claim jobs from the job store and run them until SIGTERM or SIGINT.
+
+    The bot process (``MODE=bot``) only records the jobs. Any number of
+    workers, each with its own ``WORKER_ID`` and ``METRICS_PORT``, share the
+    job store, caches and library and send the tracks to the chats
+    themselves.
+    """
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    async with app:
+        await post_init(app)
+        job_store: JobStore = app.bot_data["job_store"]
+        jobs: FairGate = app.bot_data["pool"].jobs
+        heartbeat_task = asyncio.create_task(send_heartbeats(job_store))
+        tasks: set[asyncio.Task] = set()
+        # Claimed jobs per user. Only jobs that get a slot right away are
+        # claimed, the others stay queued for idle workers to take.
+        claimed: Counter[int] = Counter()
+
+        async def work(record: JobRecord):
             try:
-                remuxed_path = None
-                if download_queue.playlist_attributes:
-                    playlist_track = download_index
-                else:
-                    playlist_track = None
-                logger.info(
-                    f'({queue_progress}) Downloading "{track_metadata["attributes"]["name"]}"'
-                )
-                await update.message.reply_text(
-                    f'({queue_progress}) Downloading "{track_metadata["attributes"]["name"]}"'
+                await run_job(app.bot, app.bot_data, record)
+            except Exception:
+                logger.exception(f'Job {record.id} for "{record.url}" failed')
+            finally:
+                claimed[record.user_id] -= 1
+
+        logger.info(f"Worker {WORKER_ID} waiting for jobs")
+        while not stopping.is_set():
+            record = None
+            if len(tasks) < jobs.capacity:
+                record = await asyncio.to_thread(
+                    job_store.claim_job,
+                    WORKER_ID,
+                    WORKER_LEASE,
+                    [
+                        user_id
+                        for user_id, count in claimed.items()
+                        if count >= jobs.max_per_user
+                    ],
                 )
-                if not track_metadata["attributes"].get("playParams"):
-                    logger.warning(
-                        f"({queue_progress}) Track is not streamable, skipping"
-                    )
-                    continue
-                if (
-                    (synced_lyrics_only and track_metadata["type"] != "songs")
-                    or (track_metadata["type"] == "music-videos" and skip_mv)
-                    or (
-                        track_metadata["type"] == "music-videos"
-                        and url_info.type == "album"
-                        and not disable_music_video_skip
-                    )
-                ):
-                    logger.warning(
-                        f"({queue_progress}) Track is not downloadable with current configuration, skipping"
-                    )
-                    continue
-                elif track_metadata["type"] == "songs":
-                    logger.debug("Getting lyrics")
-                    lyrics = downloader_song.get_lyrics(track_metadata)
-                    logger.debug("Getting webplayback")
-                    webplayback = apple_music_api.get_webplayback(track_metadata["id"])
-                    tags = downloader_song.get_tags(webplayback, lyrics.unsynced)
-                    if playlist_track:
-                        tags = {
-                            **tags,
-                            **downloader.get_playlist_tags(
-                                download_queue.playlist_attributes,
-                                playlist_track,
-                            ),
-                        }
-                    final_path = downloader.get_final_path(tags, ".m4a")
-                    lyrics_synced_path = downloader_song.get_lyrics_synced_path(
-                        final_path
-                    )
-                    cover_url = downloader.get_cover_url(track_metadata)
-                    cover_file_extesion = downloader.get_cover_file_extension(cover_url)
-                    cover_path = downloader_song.get_cover_path(
-                        final_path,
-                        cover_file_extesion,
-                    )
-                    if synced_lyrics_only:
-                        pass
-                    elif final_path.exists() and not overwrite:
-                        logger.warning(
-                            f'({queue_progress}) Song already exists at "{final_path}", skipping'
-                        )
-                    else:
-                        logger.debug("Getting stream info")
-                        if codec_song in LEGACY_CODECS:
-                            stream_info = downloader_song_legacy.get_stream_info(
-                                webplayback
-                            )
-                            logger.debug("Getting decryption key")
-                            decryption_key = downloader_song_legacy.get_decryption_key(
-                                stream_info.pssh, track_metadata["id"]
-                            )
-                        else:
-                            stream_info = downloader_song.get_stream_info(
-                                track_metadata
-                            )
-                            if not stream_info.stream_url or not stream_info.pssh:
-                                logger.warning(
-                                    f"({queue_progress}) Song is not downloadable or is not"
-                                    " available in the chosen codec, skipping"
-                                )
-                                continue
-                            logger.debug("Getting decryption key")
-                            decryption_key = downloader.get_decryption_key(
-                                stream_info.pssh, track_metadata["id"]
-                            )
-                        encrypted_path = downloader_song.get_encrypted_path(
-                            track_metadata["id"]
-                        )
-                        decrypted_path = downloader_song.get_decrypted_path(
-                            track_metadata["id"]
-                        )
-                        remuxed_path = downloader_song.get_remuxed_path(
-                            track_metadata["id"]
-                        )
-                        logger.debug(f'Downloading to "{encrypted_path}"')
-                        downloader.download(encrypted_path, stream_info.stream_url)
-                        if codec_song in LEGACY_CODECS:
-                            logger.debug(
-                                f'Decrypting/Remuxing to "{decrypted_path}"/"{remuxed_path}"'
-                            )
-                            downloader_song_legacy.remux(
-                                encrypted_path,
-                                decrypted_path,
-                                remuxed_path,
-                                decryption_key,
-                            )
-                        else:
-                            logger.debug(f'Decrypting to "{decrypted_path}"')
-                            downloader_song.decrypt(
-                                encrypted_path, decrypted_path, decryption_key
-                            )
-                            logger.debug(f'Remuxing to "{final_path}"')
-                            downloader_song.remux(
-                                decrypted_path,
-                                remuxed_path,
-                                stream_info.codec,
-                            )
-                    if no_synced_lyrics or not lyrics.synced:
-                        pass
-                    elif lyrics_synced_path.exists() and not overwrite:
-                        logger.debug(
-                            f'Synced lyrics already exists at "{lyrics_synced_path}", skipping'
-                        )
-                    else:
-                        logger.debug(f'Saving synced lyrics to "{lyrics_synced_path}"')
-                        downloader_song.save_lyrics_synced(
-                            lyrics_synced_path, lyrics.synced
-                        )
-                elif track_metadata["type"] == "music-videos":
-                    music_video_id_alt = downloader_music_video.get_music_video_id_alt(
-                        track_metadata
-                    )
-                    logger.debug("Getting iTunes page")
-                    itunes_page = itunes_api.get_itunes_page(
-                        "music-video", music_video_id_alt
-                    )
-                    if music_video_id_alt == track_metadata["id"]:
-                        stream_url = (
-                            downloader_music_video.get_stream_url_from_itunes_page(
-                                itunes_page
-                            )
-                        )
-                    else:
-                        logger.debug("Getting webplayback")
-                        webplayback = apple_music_api.get_webplayback(
-                            track_metadata["id"]
-                        )
-                        stream_url = (
-                            downloader_music_video.get_stream_url_from_webplayback(
-                                webplayback
-                            )
-                        )
-                    logger.debug("Getting M3U8 data")
-                    m3u8_data = downloader_music_video.get_m3u8_master_data(stream_url)
-                    tags = downloader_music_video.get_tags(
-                        music_video_id_alt,
-                        itunes_page,
-                        track_metadata,
-                    )
-                    if playlist_track:
-                        tags = {
-                            **tags,
-                            **downloader.get_playlist_tags(
-                                download_queue.playlist_attributes,
-                                playlist_track,
-                            ),
-                        }
-                    final_path = downloader.get_final_path(tags, ".m4v")
-                    cover_url = downloader.get_cover_url(track_metadata)
-                    cover_file_extesion = downloader.get_cover_file_extension(cover_url)
-                    cover_path = downloader_music_video.get_cover_path(
-                        final_path,
-                        cover_file_extesion,
-                    )
-                    if final_path.exists() and not overwrite:
-                        logger.warning(
-                            f'({queue_progress}) Music video already exists at "{final_path}", skipping'
-                        )
-                    else:
-                        logger.debug("Getting stream info")
-                        stream_info_video, stream_info_audio = (
-                            downloader_music_video.get_stream_info_video(m3u8_data),
-                            downloader_music_video.get_stream_info_audio(m3u8_data),
-                        )
-                        decryption_key_video = downloader.get_decryption_key(
-                            stream_info_video.pssh, track_metadata["id"]
-                        )
-                        decryption_key_audio = downloader.get_decryption_key(
-                            stream_info_audio.pssh, track_metadata["id"]
-                        )
-                        encrypted_path_video = (
-                            downloader_music_video.get_encrypted_path_video(
-                                track_metadata["id"]
-                            )
-                        )
-                        encrypted_path_audio = (
-                            downloader_music_video.get_encrypted_path_audio(
-                                track_metadata["id"]
-                            )
-                        )
-                        decrypted_path_video = (
-                            downloader_music_video.get_decrypted_path_video(
-                                track_metadata["id"]
-                            )
-                        )
-                        decrypted_path_audio = (
-                            downloader_music_video.get_decrypted_path_audio(
-                                track_metadata["id"]
-                            )
-                        )
-                        remuxed_path = downloader_music_video.get_remuxed_path(
-                            track_metadata["id"]
-                        )
-                        logger.debug(f'Downloading video to "{encrypted_path_video}"')
-                        downloader.download(
-                            encrypted_path_video, stream_info_video.stream_url
-                        )
-                        logger.debug(f'Downloading audio to "{encrypted_path_audio}"')
-                        downloader.download(
-                            encrypted_path_audio, stream_info_audio.stream_url
-                        )
-                        logger.debug(f'Decrypting video to "{decrypted_path_video}"')
-                        downloader_music_video.decrypt(
-                            encrypted_path_video,
-                            decryption_key_video,
-                            decrypted_path_video,
-                        )
-                        logger.debug(f'Decrypting audio to "{decrypted_path_audio}"')
-                        downloader_music_video.decrypt(
-                            encrypted_path_audio,
-                            decryption_key_audio,
-                            decrypted_path_audio,
-                        )
-                        logger.debug(f'Remuxing to "{remuxed_path}"')
-                        downloader_music_video.remux(
-                            decrypted_path_video,
-                            decrypted_path_audio,
-                            remuxed_path,
-                            stream_info_video.codec,
-                            stream_info_audio.codec,
-                        )
-                elif track_metadata["type"] == "uploaded-videos":
-                    stream_url = downloader_post.get_stream_url(track_metadata)
-                    tags = downloader_post.get_tags(track_metadata)
-                    final_path = downloader.get_final_path(tags, ".m4v")
-                    cover_url = downloader.get_cover_url(track_metadata)
-                    cover_file_extesion = downloader.get_cover_file_extension(cover_url)
-                    cover_path = downloader_music_video.get_cover_path(
-                        final_path,
-                        cover_file_extesion,
-                    )
-                    if final_path.exists() and not overwrite:
-                        logger.warning(
-                            f'({queue_progress}) Post video already exists at "{final_path}", skipping'
-                        )
-                    else:
-                        remuxed_path = downloader_post.get_post_temp_path(
-                            track_metadata["id"]
-                        )
-                        logger.debug(f'Downloading to "{remuxed_path}"')
-                        downloader.download_ytdlp(remuxed_path, stream_url)
-                if synced_lyrics_only or not save_cover:
+            if record is None:
+                try:
+                    await asyncio.wait_for(stopping.wait(), WORKER_POLL_INTERVAL)
+                except asyncio.TimeoutError:
                     pass
-                elif cover_path.exists() and not overwrite:
-                    logger.debug(f'Cover already exists at "{cover_path}", skipping')
-                else:
-                    logger.debug(f'Saving cover to "{cover_path}"')
-                    downloader.save_cover(cover_path, cover_url)
-                if remuxed_path:
-                    logger.debug("Applying tags")
-                    downloader.apply_tags(remuxed_path, tags, cover_url)
-                    logger.debug(f'Moving to "{final_path}"')
-                    downloader.move_to_output_path(remuxed_path, final_path)
-                if (
-                    not synced_lyrics_only
-                    and save_playlist
-                    and download_queue.playlist_attributes
-                ):
-                    playlist_file_path = downloader.get_playlist_file_path(tags)
-                    logger.debug(f'Updating M3U8 playlist from "{playlist_file_path}"')
-                    downloader.update_playlist_file(
-                        playlist_file_path,
-                        final_path,
-                        playlist_track,
-                    )
-                await context.bot.send_audio(
-                    chat_id=chat_id,
-                    title=track_metadata["attributes"]["name"],
-                    performer=track_metadata["attributes"]["artistName"],
-                    thumbnail=open(cover_path, 'rb'),
-                    audio=open(final_path, 'rb'),
-                )
-            except Exception as e:
-                error_count += 1
-                logger.error(
-                    f'({queue_progress}) Failed to download "{track_metadata["attributes"]["name"]}"',
-                    exc_info=print_exceptions,
-                )
-            finally:
-                if temp_path.exists():
-                    logger.debug(f'Cleaning up "{temp_path}"')
-                    downloader.cleanup_temp_path()
-    logger.info(f"Done ({error_count} error(s))")
+                continue
+            logger.info(f'Claimed job {record.id} for "{record.url}"')
+            claimed[record.user_id] += 1
+            task = asyncio.create_task(work(record))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        logger.info(f"Draining {len(tasks)} job(s)")
+        # The heartbeats go on while draining, so no other worker takes
+        # these jobs over in the meantime.
+        await asyncio.gather(*tasks)
+        heartbeat_task.cancel()
+        await post_stop(app)
+        await post_shutdown(app)
 
 
 if __name__ == "__main__":
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-    app.add_handler(MessageHandler(filters.TEXT, main))
-    app.run_polling()
+    logging.basicConfig(
+        format="[%(levelname)-8s %(asctime)s] %(message)s",
+        datefmt="%H:%M:%S",
+        level=logging.INFO,
+    )
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(MAX_CONCURRENT_UPDATES)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        # A local telegram-bot-api server reads uploads straight from disk,
+        # so it has to see the same paths as the bot.
+        builder = (
+            builder.base_url(f"{TELEGRAM_API_URL}/bot")
+            .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+            .local_mode(True)
+        )
+    app = builder.build()
+    app.add_handler(CommandHandler("health", health))
+    app.add_handler(CommandHandler("profile", set_profile))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, main))
+    if MODE == "worker":
+        # No updates are received, the jobs come from the job store.
+        asyncio.run(run_worker(app))
+    elif WEBHOOK_URL:
+        # Telegram echoes the secret in every request, anything without it
+        # is rejected before reaching the handlers.
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+            or hashlib.sha256(TELEGRAM_TOKEN.encode()).hexdigest(),
+            max_connections=min(MAX_CONCURRENT_UPDATES, 100),
+        )
+    else:
+        app.run_polling()
@@ -0,0 +1,139 @@
+from __future__ import annotations
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+import typing
+from collections import defaultdict
+from contextlib import contextmanager
+from config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+PREFIX = "amdl_"
+
+# Stage timings of the job running in the current context, if any.
+job_timings: contextvars.ContextVar[JobTimings | None] = contextvars.ContextVar(
+    "job_timings", default=None
+)
+
+
+class JobTimings:
+    """Time spent per stage by one job, for the summary sent to the chat."""
+
+    def __init__(self):
+        self.stages: dict[str, list[float]] = defaultdict(lambda: [0, 0.0])
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage][0] += 1
+            self.stages[stage][1] += seconds
+
+    def format(self) -> str:
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: -item[1][1])
+        return "\n".join(
+            f"{stage}: {seconds:.1f}s ({count}x)"
+            for stage, (count, seconds) in stages
+        )
+
+
+class Metrics:
+    """Counters, stage timers and gauges rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.counters: dict[tuple[str, tuple], float] = defaultdict(float)
+        self.timers: dict[tuple, list[float]] = defaultdict(lambda: [0, 0.0])
+        self.gauges: dict[str, typing.Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        with self._lock:
+            self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            self.timers[stage][0] += 1
+            self.timers[stage][1] += seconds
+        timings = job_timings.get()
+        if timings is not None:
+            timings.add(stage, seconds)
+
+    def gauge(self, name: str, func: typing.Callable[[], float]):
+        self.gauges[name] = func
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def timed(
+        self, stage: str, func: typing.Callable[..., T]
+    ) -> typing.Callable[..., T]:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.timer(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    def render(self) -> str:
+        lines = [f"# TYPE {PREFIX}stage_seconds summary"]
+        with self._lock:
+            for stage, (count, seconds) in sorted(self.timers.items()):
+                label_text = f'stage="{stage}"'
+                lines.append(f"{PREFIX}stage_seconds_count{{{label_text}}} {count}")
+                lines.append(f"{PREFIX}stage_seconds_sum{{{label_text}}} {seconds}")
+            counters = sorted(self.counters.items())
+        names = set()
+        for (name, labels), value in counters:
+            if name not in names:
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                names.add(name)
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels)
+            lines.append(f"{PREFIX}{name}{{{label_text}}} {value}")
+        for name, func in sorted(self.gauges.items()):
+            try:
+                value = func()
+            except Exception as e:
+                logger.debug(f"Could not read gauge {name}: {e}")
+                continue
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            lines.append(f"{PREFIX}{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    async def serve(
+        self, host: str = METRICS_HOST, port: int = METRICS_PORT
+    ) -> asyncio.Server:
+        """Serve ``render()`` over plain HTTP, whatever the requested path."""
+
+        async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            try:
+                while (await reader.readline()).strip():
+                    pass
+                body = self.render().encode()
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\n"
+                    b"Content-Type: text/plain; version=0.0.4\r\n"
+                    + f"Content-Length: {len(body)}\r\n".encode()
+                    + b"Connection: close\r\n\r\n"
+                    + body
+                )
+                await writer.drain()
+            finally:
+                writer.close()
+
+        server = await asyncio.start_server(handle, host, port)
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return server
+
+
+metrics = Metrics()
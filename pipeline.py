@@ -0,0 +1,93 @@
+from __future__ import annotations
+import asyncio
+import typing
+from dataclasses import dataclass, field
+
+
+@dataclass
+class PipelineItem:
+    position: int
+    data: typing.Any
+    skipped: bool = False
+    done: bool = False
+    error: BaseException | None = None
+    error_stage: str | None = None
+    results: dict = field(default_factory=dict)
+
+
+@dataclass
+class Stage:
+    name: str
+    func: typing.Callable[[PipelineItem], typing.Awaitable[typing.Any]]
+    workers: int = 1
+
+
+class Pipeline:
+    """Pushes items through a chain of stages connected by bounded queues.
+
+    Each stage has its own workers, so while one item is being downloaded
+    the next one can already be fetching its metadata. A stage's return
+    value is stored in ``item.results[stage.name]``; returning ``None``
+    marks the item as skipped and it passes through the remaining stages
+    untouched, as does an item whose stage raised or that a stage marked
+    ``done`` (already complete, but still delivered). The sink sees every
+    item exactly once, in the original order.
+    """
+
+    def __init__(self, stages: list[Stage], queue_size: int = 1):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    async def run(
+        self,
+        items: list,
+        sink: typing.Callable[[PipelineItem], typing.Awaitable[None]],
+    ):
+        queues = [asyncio.Queue(self.queue_size) for _ in self.stages]
+        queues.append(asyncio.Queue())
+        workers = [
+            asyncio.create_task(self._work(stage, queues[index], queues[index + 1]))
+            for index, stage in enumerate(self.stages)
+            for _ in range(stage.workers)
+        ]
+        delivery = asyncio.create_task(self._deliver(queues[-1], sink, len(items)))
+        try:
+            for position, data in enumerate(items):
+                await queues[0].put(PipelineItem(position, data))
+            await delivery
+        finally:
+            delivery.cancel()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(delivery, *workers, return_exceptions=True)
+
+    @staticmethod
+    async def _work(stage: Stage, queue_in: asyncio.Queue, queue_out: asyncio.Queue):
+        while True:
+            item: PipelineItem = await queue_in.get()
+            if not item.skipped and not item.done and item.error is None:
+                try:
+                    result = await stage.func(item)
+                except Exception as e:
+                    item.error = e
+                    item.error_stage = stage.name
+                else:
+                    if result is None:
+                        item.skipped = True
+                    item.results[stage.name] = result
+            await queue_out.put(item)
+
+    @staticmethod
+    async def _deliver(
+        queue: asyncio.Queue,
+        sink: typing.Callable[[PipelineItem], typing.Awaitable[None]],
+        count: int,
+    ):
+        pending: dict[int, PipelineItem] = {}
+        next_position = 0
+        while next_position < count:
+            item: PipelineItem = await queue.get()
+            pending[item.position] = item
+            while next_position in pending:
+                await sink(pending.pop(next_position))
+                next_position += 1
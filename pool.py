@@ -0,0 +1,72 @@
+from __future__ import annotations
+import asyncio
+import contextvars
+import functools
+import typing
+from concurrent.futures import ThreadPoolExecutor
+from config import (
+    WORKER_THREADS,
+    MAX_CONCURRENT_JOBS,
+    MAX_JOBS_PER_USER,
+    MAX_CONCURRENT_TRACKS,
+    MAX_TRACKS_PER_USER,
+)
+from scheduler import PRIORITY_BULK, FairGate
+
+T = typing.TypeVar("T")
+
+
+class WorkerPool:
+    """Runs blocking gamdl calls off the event loop with bounded concurrency.
+
+    Downloads, decryption and remuxing are network I/O or subprocess waits,
+    so threads are enough and, unlike processes, can share the session's
+    HTTP clients and CDM.
+
+    Jobs and the tracks they fetch each take a slot from a ``FairGate``,
+    so users share the workers round-robin and single tracks go first.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = WORKER_THREADS,
+        max_jobs: int = MAX_CONCURRENT_JOBS,
+        max_jobs_per_user: int = MAX_JOBS_PER_USER,
+        max_tracks: int = MAX_CONCURRENT_TRACKS,
+        max_tracks_per_user: int = MAX_TRACKS_PER_USER,
+    ):
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="gamdl",
+        )
+        self.jobs = FairGate(max_jobs, max_jobs_per_user)
+        self.tracks = FairGate(max_tracks, max_tracks_per_user)
+
+    async def run(self, func: typing.Callable[..., T], *args, **kwargs) -> T:
+        loop = asyncio.get_running_loop()
+        # Like asyncio.to_thread, carry the context over so per-job state
+        # such as stage timings follows the call into the worker.
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(context.run, func, *args, **kwargs),
+        )
+
+    @property
+    def queued_calls(self) -> int:
+        return self.executor._work_queue.qsize()
+
+    def slot(self, user_id: int, priority: int = PRIORITY_BULK):
+        """Hold a job slot, fairly shared with the other users."""
+        return self.jobs.slot(user_id, priority)
+
+    def track_slot(self, user_id: int, priority: int = PRIORITY_BULK):
+        """Hold a slot for fetching one track."""
+        return self.tracks.slot(user_id, priority)
+
+    @property
+    def active_jobs(self) -> int:
+        return self.jobs.active
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
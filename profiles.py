@@ -0,0 +1,140 @@
+from __future__ import annotations
+from collections import defaultdict
+from dataclasses import dataclass
+from gamdl.enums import MusicVideoCodec, PostQuality, SongCodec
+from config import (
+    CODEC_SONG,
+    CODEC_MUSIC_VIDEO,
+    QUALITY_POST,
+    COVER_SIZE,
+    UPLOAD_SIZE_LIMIT,
+    FAST_PROFILE_BUDGET,
+    DEFAULT_PROFILE,
+)
+
+# Bitrates assumed when a rendition's size has to be guessed up front.
+SONG_BITRATES = {
+    SongCodec.AAC_LEGACY: 256_000,
+    SongCodec.AAC_HE_LEGACY: 64_000,
+}
+MUSIC_VIDEO_AUDIO_BITRATE = 256_000
+DEFAULT_DURATION = 5 * 60
+
+
+@dataclass(frozen=True)
+class Profile:
+    """The codecs, cover size and size budget a request is downloaded with.
+
+    Adaptive profiles pick, per track, the best rendition whose estimated
+    size fits ``size_budget``, so it needs no re-encode before the upload.
+    """
+
+    name: str
+    codec_song: SongCodec
+    codec_music_video: MusicVideoCodec
+    quality_post: PostQuality
+    cover_size: int
+    size_budget: int = 0
+
+    def get_cache_key(self, track_type: str, track_id: str) -> tuple[str, str, int]:
+        """Key identifying one rendition of a track in the ``file_id`` cache."""
+        if track_type == "music-videos":
+            codec = self.codec_music_video.value
+        elif track_type == "uploaded-videos":
+            codec = self.quality_post.value
+        else:
+            codec = self.codec_song.value
+        if self.size_budget:
+            # A budget can pick a lower rendition than the codec alone.
+            codec = f"{codec}<{self.size_budget}"
+        return track_id, codec, self.cover_size
+
+    def get_song_codec(self, track_metadata: dict) -> SongCodec:
+        """``codec_song``, or HE-AAC if a 256k AAC stream would not fit."""
+        if (
+            self.size_budget
+            and self.codec_song == SongCodec.AAC_LEGACY
+            and estimate_size(track_metadata, SONG_BITRATES[self.codec_song])
+            > self.size_budget
+        ):
+            return SongCodec.AAC_HE_LEGACY
+        return self.codec_song
+
+    def fit_playlists(self, track_metadata: dict, playlists: list[dict]) -> list[dict]:
+        """The video renditions of an M3U8 master playlist that fit the budget.
+
+        gamdl then takes the best of them in ``codec_music_video``. Each
+        codec keeps at least its smallest rendition, so gamdl's fallback to
+        H.264 always has something to pick.
+        """
+        if not self.size_budget:
+            return playlists
+        by_codec: dict[str, list[dict]] = defaultdict(list)
+        for playlist in playlists:
+            by_codec[playlist["stream_info"]["codecs"][:4]].append(playlist)
+        fitted = []
+        for codec_playlists in by_codec.values():
+            fitting = [
+                playlist
+                for playlist in codec_playlists
+                if estimate_size(
+                    track_metadata,
+                    playlist["stream_info"]["bandwidth"] + MUSIC_VIDEO_AUDIO_BITRATE,
+                )
+                <= self.size_budget
+            ]
+            fitted += fitting or [
+                min(
+                    codec_playlists,
+                    key=lambda playlist: playlist["stream_info"]["bandwidth"],
+                )
+            ]
+        return fitted
+
+
+def estimate_size(track_metadata: dict, bitrate: int) -> int:
+    duration_ms = track_metadata["attributes"].get("durationInMillis")
+    duration = duration_ms / 1000 if duration_ms else DEFAULT_DURATION
+    return int(duration * bitrate / 8)
+
+
+PROFILES = {
+    profile.name: profile
+    for profile in (
+        Profile(
+            "standard",
+            SongCodec(CODEC_SONG),
+            MusicVideoCodec(CODEC_MUSIC_VIDEO),
+            PostQuality(QUALITY_POST),
+            COVER_SIZE,
+        ),
+        Profile(
+            "fast",
+            SongCodec.AAC_HE_LEGACY,
+            MusicVideoCodec.H264,
+            PostQuality.BEST,
+            COVER_SIZE,
+            FAST_PROFILE_BUDGET,
+        ),
+        Profile(
+            "archive",
+            SongCodec.AAC_LEGACY,
+            MusicVideoCodec.H265,
+            PostQuality.BEST,
+            1200,
+        ),
+        Profile(
+            "auto",
+            SongCodec(CODEC_SONG),
+            MusicVideoCodec.H264,
+            PostQuality.BEST,
+            COVER_SIZE,
+            UPLOAD_SIZE_LIMIT,
+        ),
+    )
+}
+
+
+def get_profile(name: str | None) -> Profile:
+    """The profile called ``name``, or the default one if there is none."""
+    return PROFILES.get(name) or PROFILES[DEFAULT_PROFILE]
@@ -0,0 +1,98 @@
+from __future__ import annotations
+import asyncio
+import re
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+
+PRIORITY_SINGLE = 0
+PRIORITY_BULK = 1
+
+# Song links and album links pointing at one track (``?i=``).
+SINGLE_TRACK_URL_RE = re.compile(r"/(song|music-video|post)/|[?&]i=\d+")
+
+
+def get_priority(url: str) -> int:
+    if SINGLE_TRACK_URL_RE.search(url):
+        return PRIORITY_SINGLE
+    return PRIORITY_BULK
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class FairGate:
+    """Hands out ``capacity`` slots round-robin across users.
+
+    Waiters of a lower priority value are always served first. Within a
+    priority, users take turns, so one user queueing hundreds of tracks
+    only ever gets every n-th free slot, and never more than
+    ``max_per_user`` at once.
+    """
+
+    def __init__(self, capacity: int, max_per_user: int):
+        self.capacity = capacity
+        self.max_per_user = max_per_user
+        self.active = 0
+        self.active_per_user: dict[int, int] = defaultdict(int)
+        self.waiters: dict[int, OrderedDict[int, deque[asyncio.Future]]] = (
+            defaultdict(OrderedDict)
+        )
+
+    @asynccontextmanager
+    async def slot(self, user_id: int, priority: int = PRIORITY_BULK):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].setdefault(user_id, deque()).append(future)
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # The slot may have been granted right before the cancellation.
+            if future.done() and not future.cancelled():
+                self._release(user_id)
+            raise
+        try:
+            yield
+        finally:
+            self._release(user_id)
+
+    @property
+    def waiting(self) -> int:
+        return sum(
+            len(futures)
+            for users in self.waiters.values()
+            for futures in users.values()
+        )
+
+    def _release(self, user_id: int):
+        self.active -= 1
+        self.active_per_user[user_id] -= 1
+        if not self.active_per_user[user_id]:
+            del self.active_per_user[user_id]
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.active < self.capacity:
+            picked = self._pick()
+            if picked is None:
+                return
+            users, user_id = picked
+            future = users[user_id].popleft()
+            if users[user_id]:
+                # Back of the line until every other user had a turn.
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            if future.cancelled():
+                continue
+            self.active += 1
+            self.active_per_user[user_id] += 1
+            future.set_result(None)
+
+    def _pick(self) -> tuple[OrderedDict[int, deque], int] | None:
+        for priority in sorted(self.waiters):
+            users = self.waiters[priority]
+            for user_id in users:
+                if self.active_per_user.get(user_id, 0) < self.max_per_user:
+                    return users, user_id
+        return None
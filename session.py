@@ -0,0 +1,452 @@
+from __future__ import annotations
+import copy
+import logging
+import re
+import threading
+import time
+import typing
+from dataclasses import dataclass
+from pathlib import Path
+from gamdl.apple_music_api import AppleMusicApi
+from gamdl.constants import X_NOT_FOUND_STRING, LEGACY_CODECS
+from gamdl.enums import (
+    CoverFormat,
+    DownloadMode,
+    MusicVideoCodec,
+    PostQuality,
+    RemuxMode,
+    SongCodec,
+    SyncedLyricsFormat,
+)
+from gamdl.itunes_api import ItunesApi
+from api_cache import ApiCache
+from artwork import ArtworkCache
+from config import (
+    SESSION_REFRESH_INTERVAL,
+    COOKIES_PATH,
+    OUTPUT_PATH,
+    TEMP_PATH,
+    WVD_PATH,
+    LANGUAGE,
+    CODEC_SONG,
+    CODEC_MUSIC_VIDEO,
+    QUALITY_POST,
+    COVER_SIZE,
+    FFMPEG_PATH,
+    MP4DECRYPT_PATH,
+    NM3U8DLRE_PATH,
+    MP4BOX_PATH,
+)
+from http_pool import mount_http_adapter
+from metrics import metrics
+from profiles import PROFILES, Profile
+
+if typing.TYPE_CHECKING:
+    from gamdl.downloader_music_video import DownloaderMusicVideo
+    from gamdl.downloader_post import DownloaderPost
+    from gamdl.downloader_song import DownloaderSong
+    from gamdl.downloader_song_legacy import DownloaderSongLegacy
+    from stream import ResumableDownloader
+
+logger = logging.getLogger(__name__)
+
+T = typing.TypeVar("T")
+
+
+@dataclass(frozen=True)
+class DownloaderConfig:
+    """Options passed to gamdl, resolved once at import.
+
+    The defaults mirror gamdl's own, written out so they are not read back
+    from its constructor signatures, which would import all of gamdl.
+    """
+
+    disable_music_video_skip: bool = True
+    save_cover: bool = True
+    overwrite: bool = True
+    save_playlist: bool = False
+    synced_lyrics_only: bool = False
+    no_synced_lyrics: bool = False
+    print_exceptions: bool = True
+    cookies_path: Path = Path("./data/cookies.txt")
+    language: str = "en-US"
+    output_path: Path = Path("./Apple Music")
+    temp_path: Path = Path("./temp")
+    wvd_path: Path | None = None
+    nm3u8dlre_path: str = "N_m3u8DL-RE"
+    mp4decrypt_path: str = "mp4decrypt"
+    ffmpeg_path: str = "ffmpeg"
+    mp4box_path: str = "MP4Box"
+    download_mode: DownloadMode = DownloadMode.YTDLP
+    remux_mode: RemuxMode = RemuxMode.FFMPEG
+    cover_format: CoverFormat = CoverFormat.JPG
+    template_folder_album: str = "{album_artist}/{album}"
+    template_folder_compilation: str = "Compilations/{album}"
+    template_file_single_disc: str = "{track:02d} {title}"
+    template_file_multi_disc: str = "{disc}-{track:02d} {title}"
+    template_folder_no_album: str = "{artist}/Unknown Album"
+    template_file_no_album: str = "{title}"
+    template_file_playlist: str = "Playlists/{playlist_title}"
+    template_date: str = "%Y-%m-%dT%H:%M:%SZ"
+    exclude_tags: str | None = None
+    cover_size: int = 320
+    truncate: int | None = None
+    codec_song: SongCodec = SongCodec.AAC_LEGACY
+    synced_lyrics_format: SyncedLyricsFormat = SyncedLyricsFormat.LRC
+    codec_music_video: MusicVideoCodec = MusicVideoCodec.H264
+    quality_post: PostQuality = PostQuality.BEST
+
+
+downloader_config = DownloaderConfig(
+    cookies_path=COOKIES_PATH.resolve(),
+    language=LANGUAGE,
+    output_path=OUTPUT_PATH,
+    temp_path=TEMP_PATH,
+    wvd_path=WVD_PATH,
+    nm3u8dlre_path=NM3U8DLRE_PATH,
+    mp4decrypt_path=MP4DECRYPT_PATH,
+    ffmpeg_path=FFMPEG_PATH,
+    mp4box_path=MP4BOX_PATH,
+    cover_size=COVER_SIZE,
+    codec_song=SongCodec(CODEC_SONG),
+    codec_music_video=MusicVideoCodec(CODEC_MUSIC_VIDEO),
+    quality_post=PostQuality(QUALITY_POST),
+)
+
+# Apple answers with these once the media-user-token or the bearer token
+# scraped from the web player has expired.
+EXPIRED_STATUS_RE = re.compile(r"status code (401|403)\b")
+
+
+class SessionError(Exception):
+    pass
+
+
+@dataclass
+class Components:
+    apple_music_api: AppleMusicApi
+    itunes_api: ItunesApi
+    downloader: ResumableDownloader
+    downloader_song: DownloaderSong
+    downloader_song_legacy: DownloaderSongLegacy
+    downloader_music_video: DownloaderMusicVideo
+    downloader_post: DownloaderPost
+    skip_mv: bool
+    cache: ApiCache
+    artwork: ArtworkCache
+    profile: Profile = PROFILES["standard"]
+
+    def cached(
+        self,
+        name: str,
+        key: typing.Hashable,
+        func: typing.Callable[..., T],
+        *args,
+        **kwargs,
+    ) -> T:
+        """Call ``func`` through the API cache under ``(name, key)``.
+
+        The storefront and language are part of the key, since Apple answers
+        differently for each of them.
+        """
+        return self.cache.get_or_call(
+            (
+                self.apple_music_api.storefront,
+                self.apple_music_api.language,
+                name,
+                key,
+            ),
+            metrics.timed(name, func),
+            *args,
+            **kwargs,
+        )
+
+    def with_temp_path(self, path: Path) -> Components:
+        """Return a copy whose downloaders write their temporary files to ``path``.
+
+        The copies are shallow, so the HTTP sessions and the CDM stay shared.
+        """
+        return self._copy(temp_path=path)
+
+    def with_profile(self, profile: Profile) -> Components:
+        """Return a copy downloading in the codecs and cover size of ``profile``.
+
+        Other profiles than the standard one write to a subdirectory named
+        after them, so renditions of the same track never share a file.
+        """
+        output_path = downloader_config.output_path
+        if profile.name != "standard":
+            output_path = output_path / profile.name
+        components = self._copy(cover_size=profile.cover_size, output_path=output_path)
+        components.profile = profile
+        components.downloader_song.codec = profile.codec_song
+        components.downloader_song_legacy.codec = profile.codec_song
+        components.downloader_music_video.codec = profile.codec_music_video
+        components.downloader_post.quality = profile.quality_post
+        return components
+
+    def _copy(self, **downloader_attributes) -> Components:
+        downloader = copy.copy(self.downloader)
+        for name, value in downloader_attributes.items():
+            setattr(downloader, name, value)
+        components = copy.copy(self)
+        components.downloader = downloader
+        for name in (
+            "downloader_song",
+            "downloader_song_legacy",
+            "downloader_music_video",
+            "downloader_post",
+        ):
+            sub_downloader = copy.copy(getattr(self, name))
+            sub_downloader.downloader = downloader
+            setattr(components, name, sub_downloader)
+        return components
+
+
+class DownloaderSession:
+    """Apple Music clients and downloaders shared by every handler.
+
+    Everything is built once and swapped atomically on refresh, so a
+    handler that grabbed ``components`` keeps a consistent set even if a
+    refresh happens while it is still downloading.
+    """
+
+    def __init__(
+        self,
+        cache: ApiCache | None = None,
+        artwork: ArtworkCache | None = None,
+        refresh_interval: int = SESSION_REFRESH_INTERVAL,
+    ):
+        self.cache = cache if cache is not None else ApiCache(path=None)
+        self.artwork = artwork if artwork is not None else ArtworkCache()
+        self.refresh_interval = refresh_interval
+        self.components: Components | None = None
+        self.created_at: float | None = None
+        self.cookies_mtime: float | None = None
+        self.last_error: str | None = None
+        self.refresh_count = 0
+        self._lock = threading.Lock()
+
+    def build(self) -> Components:
+        # Imported here, not at the top: gamdl's downloaders pull in yt-dlp,
+        # Pillow and pywidevine, which the bot does not need to start.
+        from gamdl.downloader_music_video import DownloaderMusicVideo
+        from gamdl.downloader_post import DownloaderPost
+        from gamdl.downloader_song import DownloaderSong
+        from gamdl.downloader_song_legacy import DownloaderSongLegacy
+        from stream import ResumableDownloader
+
+        logger.debug("Starting downloader")
+        if not downloader_config.cookies_path.exists():
+            raise SessionError(
+                X_NOT_FOUND_STRING.format(
+                    "Cookies file", downloader_config.cookies_path
+                )
+            )
+        apple_music_api = AppleMusicApi(
+            downloader_config.cookies_path,
+            language=downloader_config.language,
+        )
+        itunes_api = ItunesApi(
+            apple_music_api.storefront,
+            apple_music_api.language,
+        )
+        mount_http_adapter(apple_music_api.session)
+        mount_http_adapter(itunes_api.session)
+        downloader = ResumableDownloader(
+            apple_music_api,
+            itunes_api,
+            output_path=downloader_config.output_path,
+            temp_path=downloader_config.temp_path,
+            wvd_path=downloader_config.wvd_path,
+            nm3u8dlre_path=downloader_config.nm3u8dlre_path,
+            mp4decrypt_path=downloader_config.mp4decrypt_path,
+            ffmpeg_path=downloader_config.ffmpeg_path,
+            mp4box_path=downloader_config.mp4box_path,
+            download_mode=downloader_config.download_mode,
+            remux_mode=downloader_config.remux_mode,
+            cover_format=downloader_config.cover_format,
+            template_folder_album=downloader_config.template_folder_album,
+            template_folder_compilation=downloader_config.template_folder_compilation,
+            template_file_single_disc=downloader_config.template_file_single_disc,
+            template_file_multi_disc=downloader_config.template_file_multi_disc,
+            template_folder_no_album=downloader_config.template_folder_no_album,
+            template_file_no_album=downloader_config.template_file_no_album,
+            template_file_playlist=downloader_config.template_file_playlist,
+            template_date=downloader_config.template_date,
+            exclude_tags=downloader_config.exclude_tags,
+            cover_size=downloader_config.cover_size,
+            truncate=downloader_config.truncate,
+        )
+        # Covers are read for the file extension, the tags and the cover
+        # file, always from the artwork cache instead of gamdl's unbounded
+        # in-memory one.
+        downloader.get_url_response_bytes = self.artwork.get_bytes
+        skip_mv = False
+        if not downloader_config.synced_lyrics_only:
+            if downloader_config.wvd_path and not downloader_config.wvd_path.exists():
+                raise SessionError(
+                    X_NOT_FOUND_STRING.format(".wvd file", downloader_config.wvd_path)
+                )
+            logger.debug("Setting up CDM")
+            downloader.set_cdm()
+            skip_mv = self.check_tools(downloader)
+        return Components(
+            apple_music_api=apple_music_api,
+            itunes_api=itunes_api,
+            downloader=downloader,
+            downloader_song=DownloaderSong(
+                downloader,
+                downloader_config.codec_song,
+                downloader_config.synced_lyrics_format,
+            ),
+            downloader_song_legacy=DownloaderSongLegacy(
+                downloader,
+                downloader_config.codec_song,
+            ),
+            downloader_music_video=DownloaderMusicVideo(
+                downloader,
+                downloader_config.codec_music_video,
+            ),
+            downloader_post=DownloaderPost(
+                downloader,
+                downloader_config.quality_post,
+            ),
+            skip_mv=skip_mv,
+            cache=self.cache,
+            artwork=self.artwork,
+        )
+
+    @staticmethod
+    def check_tools(downloader: ResumableDownloader) -> bool:
+        """Raise if a required binary is missing, return whether to skip music videos."""
+        options = downloader_config
+        if not downloader.ffmpeg_path_full and (
+            options.remux_mode == RemuxMode.FFMPEG
+            or options.download_mode == DownloadMode.NM3U8DLRE
+        ):
+            raise SessionError(X_NOT_FOUND_STRING.format("ffmpeg", options.ffmpeg_path))
+        if not downloader.mp4box_path_full and options.remux_mode == RemuxMode.MP4BOX:
+            raise SessionError(X_NOT_FOUND_STRING.format("MP4Box", options.mp4box_path))
+        if (
+            not downloader.mp4decrypt_path_full
+            and options.codec_song
+            not in (
+                SongCodec.AAC_LEGACY,
+                SongCodec.AAC_HE_LEGACY,
+            )
+            or (
+                options.remux_mode == RemuxMode.MP4BOX
+                and not downloader.mp4decrypt_path_full
+            )
+        ):
+            raise SessionError(
+                X_NOT_FOUND_STRING.format("mp4decrypt", options.mp4decrypt_path)
+            )
+        if (
+            options.download_mode == DownloadMode.NM3U8DLRE
+            and not downloader.nm3u8dlre_path_full
+        ):
+            raise SessionError(
+                X_NOT_FOUND_STRING.format("N_m3u8DL-RE", options.nm3u8dlre_path)
+            )
+        if options.codec_song not in LEGACY_CODECS:
+            logger.warning(
+                "You have chosen a non-legacy codec. Support for non-legacy codecs are not guaranteed, "
+                "as most of the songs cannot be downloaded when using non-legacy codecs."
+            )
+        if not downloader.mp4decrypt_path_full:
+            logger.warning(
+                X_NOT_FOUND_STRING.format("mp4decrypt", options.mp4decrypt_path)
+                + ", music videos will not be downloaded"
+            )
+            return True
+        return False
+
+    def refresh(self, built_at: float | None = None) -> bool:
+        """Rebuild the components, keeping the old ones if the rebuild fails.
+
+        With ``built_at``, the components built at that time are replaced
+        only once: if they were rebuilt since, nothing is done.
+        """
+        with self._lock:
+            if built_at is not None and self.created_at != built_at:
+                return self.components is not None
+            cookies_mtime = self._get_cookies_mtime()
+            try:
+                components = self.build()
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"
+                logger.error(f"Failed to build downloader session: {self.last_error}")
+                return False
+            self.components = components
+            self.created_at = time.monotonic()
+            self.cookies_mtime = cookies_mtime
+            self.last_error = None
+            self.refresh_count += 1
+            logger.info(f"Downloader session ready (build #{self.refresh_count})")
+            return True
+
+    def is_stale(self) -> bool:
+        if self.components is None:
+            return True
+        if time.monotonic() - self.created_at >= self.refresh_interval:
+            return True
+        return self._get_cookies_mtime() != self.cookies_mtime
+
+    def refresh_if_stale(self) -> bool:
+        if not self.is_stale():
+            return False
+        return self.refresh()
+
+    def handle_error(
+        self, exception: BaseException, built_at: float | None = None
+    ) -> bool:
+        """Rebuild the session if ``exception`` looks like an expired cookie or token.
+
+        ``built_at`` is the ``created_at`` of the components that failed, so
+        the tracks of an album failing together cause a single rebuild.
+        """
+        if not EXPIRED_STATUS_RE.search(str(exception)):
+            return False
+        if built_at is not None and self.created_at != built_at:
+            return True
+        logger.warning("Apple Music rejected the session, rebuilding it")
+        return self.refresh(built_at)
+
+    def get(self) -> Components:
+        if self.components is None:
+            raise SessionError(self.last_error or "Downloader session is not ready")
+        return self.components
+
+    def health(self) -> dict:
+        return {
+            "ready": self.components is not None,
+            "age": (
+                int(time.monotonic() - self.created_at)
+                if self.created_at is not None
+                else None
+            ),
+            "refresh_count": self.refresh_count,
+            "storefront": (
+                self.components.apple_music_api.storefront
+                if self.components is not None
+                else None
+            ),
+            "skip_mv": (
+                self.components.skip_mv if self.components is not None else None
+            ),
+            "last_error": self.last_error,
+            "api_cache_size": len(self.cache),
+            "api_cache_hits": self.cache.hits,
+            "api_cache_misses": self.cache.misses,
+            "artwork_cache_size": self.artwork.get_size(),
+            "artwork_cache_hits": self.artwork.hits,
+        }
+
+    @staticmethod
+    def _get_cookies_mtime() -> float | None:
+        try:
+            return downloader_config.cookies_path.stat().st_mtime
+        except OSError:
+            return None
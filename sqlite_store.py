@@ -0,0 +1,17 @@
+from __future__ import annotations
+import sqlite3
+from pathlib import Path
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    """Open a SQLite database shared by the bot and the worker processes.
+
+    WAL lets readers in other processes go on while one of them writes,
+    and the timeout makes a writer wait for the lock instead of failing.
+    The connection is used from pool threads, serialized by each store's
+    own lock.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+    connection.execute("PRAGMA journal_mode=WAL")
+    return connection
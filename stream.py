@@ -0,0 +1,69 @@
+from __future__ import annotations
+import logging
+import time
+import typing
+from pathlib import Path
+from yt_dlp import YoutubeDL
+from gamdl.downloader import Downloader
+from config import (
+    STREAM_FRAGMENT_THREADS,
+    STREAM_RETRIES,
+    STREAM_CHUNK_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ResumableDownloader(Downloader):
+    """``Downloader`` whose stream downloads survive network blips.
+
+    yt-dlp fetches the HLS fragments in parallel and retries each one on
+    its own. If the whole download still fails, it is started again on top
+    of the partial file, and yt-dlp picks up from the last fragment it
+    finished instead of starting over.
+    """
+
+    def download_ytdlp(self, path: Path, stream_url: str):
+        self._retry(self._download_ytdlp, path, stream_url)
+
+    def download_nm3u8dlre(self, path: Path, stream_url: str):
+        self._retry(super().download_nm3u8dlre, path, stream_url)
+
+    @staticmethod
+    def _retry(
+        download: typing.Callable[[Path, str], None], path: Path, stream_url: str
+    ):
+        for attempt in range(STREAM_RETRIES + 1):
+            try:
+                return download(path, stream_url)
+            except Exception as e:
+                if attempt == STREAM_RETRIES:
+                    raise
+                delay = 2**attempt
+                logger.warning(
+                    f'Download of "{path.name}" failed ({e}), resuming in {delay}s'
+                )
+                time.sleep(delay)
+
+    def _download_ytdlp(self, path: Path, stream_url: str):
+        # yt-dlp fetches the fragments with its own HTTP stack, not through
+        # http_pool: connections are only reused within one download.
+        with YoutubeDL(
+            {
+                "quiet": True,
+                "no_warnings": True,
+                "outtmpl": str(path),
+                "allow_unplayable_formats": True,
+                "fixup": "never",
+                "allowed_extractors": ["generic"],
+                "noprogress": True,
+                "concurrent_fragment_downloads": STREAM_FRAGMENT_THREADS,
+                "fragment_retries": STREAM_RETRIES,
+                "retries": STREAM_RETRIES,
+                # A missing fragment would silently corrupt the track.
+                "skip_unavailable_fragments": False,
+                "continuedl": True,
+                "http_chunk_size": STREAM_CHUNK_SIZE,
+            }
+        ) as ydl:
+            ydl.download(stream_url)
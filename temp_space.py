@@ -0,0 +1,80 @@
+from __future__ import annotations
+import logging
+import shutil
+from pathlib import Path
+from config import TEMP_RAM_PATH, TEMP_RAM_BUDGET
+
+logger = logging.getLogger(__name__)
+
+# Generous upper bounds on stream size per second of track, so that the
+# encrypted, decrypted and remuxed copies of a track fit in its reservation.
+BYTES_PER_SECOND = {
+    "songs": 200_000,
+    "music-videos": 1_500_000,
+    "uploaded-videos": 1_500_000,
+}
+INTERMEDIATE_COPIES = 3
+DEFAULT_DURATION = 10 * 60
+
+
+def estimate_temp_size(track_metadata: dict) -> int:
+    duration_ms = track_metadata["attributes"].get("durationInMillis")
+    duration = duration_ms / 1000 if duration_ms else DEFAULT_DURATION
+    bytes_per_second = BYTES_PER_SECOND.get(
+        track_metadata["type"], BYTES_PER_SECOND["music-videos"]
+    )
+    return int(duration * bytes_per_second * INTERMEDIATE_COPIES)
+
+
+class TempSpace:
+    """Places per-track temp directories on a RAM-backed filesystem.
+
+    Tracks reserve their estimated size up front. While the reservations
+    fit in ``budget`` the intermediates go to ``ram_path`` (tmpfs), any
+    track that does not fit spills to the regular ``disk_path``.
+    """
+
+    def __init__(
+        self,
+        disk_path: Path,
+        ram_path: Path | None = TEMP_RAM_PATH,
+        budget: int = TEMP_RAM_BUDGET,
+    ):
+        self.disk_path = disk_path
+        self.ram_path = ram_path
+        self.budget = budget
+        self.reserved = 0
+        self.spills = 0
+
+    def reserve(self, size: int) -> Path:
+        """Return the root to put a track's temp directory in.
+
+        Other processes may share ``ram_path``, so the reservation must
+        also fit in the space actually left on it.
+        """
+        if (
+            self.ram_path is not None
+            and self.reserved + size <= self.budget
+            and size <= self._get_free_space()
+        ):
+            self.reserved += size
+            return self.ram_path
+        if self.ram_path is not None:
+            self.spills += 1
+            logger.debug(f"RAM temp budget exhausted, spilling {size} bytes to disk")
+        return self.disk_path
+
+    def release(self, root: Path, size: int):
+        if self.ram_path is not None and root == self.ram_path:
+            self.reserved -= size
+
+    def _get_free_space(self) -> int:
+        try:
+            return shutil.disk_usage(self.ram_path).free
+        except OSError:
+            return 0
+
+    def roots(self) -> list[Path]:
+        if self.ram_path is None:
+            return [self.disk_path]
+        return [self.ram_path, self.disk_path]
@@ -0,0 +1,32 @@
+from __future__ import annotations
+import io
+from pathlib import Path
+from PIL import Image
+from artwork import ArtworkCache
+
+
+class FakeArtworkCache(ArtworkCache):
+    def fetch(self, url: str) -> bytes:
+        cover = io.BytesIO()
+        Image.new("RGB", (64, 64)).save(cover, "JPEG")
+        return cover.getvalue()
+
+
+def test_shared_directory(tmp_path: Path):
+    first = FakeArtworkCache(tmp_path, budget=0)
+    second = FakeArtworkCache(tmp_path, budget=0)
+    first.get_bytes("https://example.invalid/a.jpg")
+    second.get_bytes("https://example.invalid/a.jpg")
+    assert (first.misses, second.hits) == (1, 1)
+
+
+def test_cover_evicted_by_another_process(tmp_path: Path):
+    first = FakeArtworkCache(tmp_path, budget=1)
+    second = FakeArtworkCache(tmp_path, budget=1)
+    first.get_path("https://example.invalid/a.jpg")
+    # Fetching another cover over the budget evicts the first one.
+    second.get_path("https://example.invalid/b.jpg")
+    assert second.evictions == 1
+    assert first.get_bytes("https://example.invalid/a.jpg")
+    assert first.get_thumbnail("https://example.invalid/a.jpg")
+    assert first.misses == 2
@@ -0,0 +1,39 @@
+from __future__ import annotations
+import asyncio
+from coalesce import InFlightTracks
+
+
+def test_claim_and_resolve():
+    async def run():
+        in_flight = InFlightTracks()
+        assert in_flight.claim("x") is None
+        future = in_flight.claim("x")
+        assert future is not None
+        assert in_flight.coalesced == 1
+        in_flight.resolve("x", "file-1")
+        assert await future == "file-1"
+        assert len(in_flight) == 0
+        assert in_flight.claim("x") is None
+
+    asyncio.run(run())
+
+
+def test_hold_flushes_once_someone_waits():
+    async def run():
+        in_flight = InFlightTracks()
+        flushes = []
+        in_flight.claim("x")
+        in_flight.hold("x", lambda: flushes.append("x"))
+        assert flushes == []
+        in_flight.claim("x")
+        assert flushes == ["x"]
+        # A waiter that came before the track was buffered.
+        in_flight.claim("y")
+        in_flight.claim("y")
+        in_flight.hold("y", lambda: flushes.append("y"))
+        assert flushes == ["x", "y"]
+        in_flight.resolve("x", None)
+        in_flight.resolve("y", None)
+        assert not in_flight.flushes and not in_flight.wanted
+
+    asyncio.run(run())
@@ -0,0 +1,37 @@
+from __future__ import annotations
+import asyncio
+from types import SimpleNamespace
+from telegram.error import BadRequest, TimedOut
+from delivery import ProgressMessage, TelegramLimiter
+
+
+class FailingBot:
+    def __init__(self, error: Exception):
+        self.error = error
+        self.calls = []
+
+    async def send_message(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.error is not None:
+            raise self.error
+        return SimpleNamespace(edit_text=self.edit_text)
+
+    async def edit_text(self, text: str):
+        raise BadRequest("Message to edit not found")
+
+
+def test_failed_status_message_does_not_raise():
+    async def run():
+        bot = FailingBot(BadRequest("Message to be replied not found"))
+        progress = ProgressMessage(bot, TelegramLimiter(), 1, 2, interval=0)
+        await progress.update("Downloading")
+        bot.error = TimedOut()
+        await progress.update("Downloading again")
+        assert progress.message is None
+        bot.error = None
+        await progress.update("Done")
+        await progress.update("Done, really")
+        assert progress.message is not None
+        assert all(call["allow_sending_without_reply"] for call in bot.calls)
+
+    asyncio.run(run())
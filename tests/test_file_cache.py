@@ -0,0 +1,21 @@
+from __future__ import annotations
+from pathlib import Path
+from file_cache import FileIdCache
+
+
+def test_least_recently_used_are_evicted_in_batches(tmp_path: Path):
+    cache = FileIdCache("1", tmp_path / "file_ids.sqlite3", max_size=10)
+    try:
+        for index in range(10):
+            cache.set(str(index), "aac", 1200, f"file-{index}")
+        assert cache.get("0", "aac", 1200) == "file-0"
+        cache.set("10", "aac", 1200, "file-10")
+        # One over the limit evicts that one plus a tenth of the cache.
+        assert cache.get("1", "aac", 1200) is None
+        assert cache.get("2", "aac", 1200) is None
+        assert cache.get("0", "aac", 1200) == "file-0"
+        assert cache.get("10", "aac", 1200) == "file-10"
+        (count,) = cache.connection.execute("SELECT COUNT(*) FROM file_ids").fetchone()
+        assert count == 9
+    finally:
+        cache.close()
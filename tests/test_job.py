@@ -0,0 +1,231 @@
+from __future__ import annotations
+import asyncio
+import io
+import itertools
+import time
+from pathlib import Path
+from types import SimpleNamespace
+import pytest
+from PIL import Image
+import job
+from artwork import ArtworkCache
+from benchmark import (
+    FakeAppleMusicApi,
+    FakeBot,
+    FakeDownloader,
+    FakeItunesApi,
+    FakeSubDownloader,
+    Settings,
+    make_track,
+)
+from coalesce import InFlightTracks
+from delivery import TelegramLimiter
+from file_cache import FileIdCache
+from job import DownloadJob
+from job_store import JobStore
+from library import LibraryIndex
+from pipeline import PipelineItem
+from pool import WorkerPool
+from session import Components, DownloaderSession, downloader_config
+from temp_space import TempSpace
+from transcode import TooLargeError
+
+album_ids = itertools.count(1)
+
+
+class FakeArtworkCache(ArtworkCache):
+    def fetch(self, url: str) -> bytes:
+        cover = io.BytesIO()
+        Image.new("RGB", (64, 64)).save(cover, "JPEG")
+        return cover.getvalue()
+
+
+class SlowFileIdCache(FileIdCache):
+    """Looks some tracks up slowly, so later positions overtake them."""
+
+    def __init__(self, *args, slow: set[str], **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slow = slow
+
+    def get(self, track_id: str, codec: str, cover_size: int) -> str | None:
+        if track_id in self.slow:
+            time.sleep(0.2)
+        return super().get(track_id, codec, cover_size)
+
+
+class Environment:
+    """The bot_data of a worker, backed by the benchmark's fakes."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.settings = Settings(
+            api_latency=0,
+            download_rate=0,
+            track_size=1000,
+            video_size=2000,
+            process_latency=0,
+            upload_rate=0,
+            album_size=0,
+            users=0,
+        )
+        self.downloader = FakeDownloader(
+            self.settings, downloader_config.output_path, downloader_config.temp_path
+        )
+        self.bot = FakeBot(latency=0, upload_rate=0)
+        self.session = DownloaderSession(artwork=FakeArtworkCache(path / "artwork"))
+        self.session.build = self.build
+        self.session.refresh()
+        self.bot_data = {
+            "session": self.session,
+            "pool": WorkerPool(),
+            "file_id_cache": FileIdCache("1", path / "file_ids.sqlite3"),
+            "job_store": JobStore(path / "jobs.sqlite3"),
+            "in_flight": InFlightTracks(),
+            "library": LibraryIndex(
+                downloader_config.output_path, path / "library.sqlite3"
+            ),
+            "temp_space": TempSpace(downloader_config.temp_path, ram_path=None),
+            "telegram_limiter": TelegramLimiter(),
+        }
+
+    def build(self) -> Components:
+        return Components(
+            apple_music_api=FakeAppleMusicApi(self.settings),
+            itunes_api=FakeItunesApi(self.settings),
+            downloader=self.downloader,
+            downloader_song=FakeSubDownloader(self.downloader),
+            downloader_song_legacy=FakeSubDownloader(self.downloader),
+            downloader_music_video=FakeSubDownloader(self.downloader),
+            downloader_post=FakeSubDownloader(self.downloader),
+            skip_mv=False,
+            cache=self.session.cache,
+            artwork=self.session.artwork,
+        )
+
+    def add_album(self, tracks: list[dict]) -> str:
+        album_id = f"album-{next(album_ids)}"
+        self.downloader.albums[album_id] = tracks
+        return f"https://music.apple.com/us/album/{album_id}"
+
+    def make_job(self, user_id: int, url: str, **bot_data) -> DownloadJob:
+        record = self.bot_data["job_store"].add_job(user_id, user_id, 1, url, "1/1")
+        return DownloadJob(
+            self.bot,
+            {**self.bot_data, **bot_data},
+            self.session.get(),
+            record,
+        )
+
+    def close(self):
+        self.bot_data["pool"].shutdown()
+        for name in ("file_id_cache", "job_store", "library"):
+            self.bot_data[name].close()
+
+
+@pytest.fixture
+def environment(tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+    # The downloader's output and temp paths are relative to the cwd.
+    monkeypatch.chdir(tmp_path)
+    environment = Environment(tmp_path)
+    yield environment
+    environment.close()
+
+
+async def run_jobs(*jobs: DownloadJob) -> list[int]:
+    return await asyncio.wait_for(asyncio.gather(*(job.run() for job in jobs)), 10)
+
+
+def test_album_is_sent_as_one_media_group(environment: Environment):
+    tracks = [make_track("songs", "album") for _ in range(3)]
+    job = environment.make_job(1, environment.add_album(tracks))
+    assert asyncio.run(run_jobs(job)) == [0]
+    deliveries = environment.bot.deliveries[1]
+    # Tracks of one media group arrive at the same time.
+    assert len(deliveries) == 3 and len(set(deliveries)) == 1
+
+
+def test_repeated_track_in_one_job(environment: Environment):
+    first, second = (make_track("songs", "album") for _ in range(2))
+    job = environment.make_job(1, environment.add_album([first, second, first]))
+    assert asyncio.run(run_jobs(job)) == [0]
+    assert len(environment.bot.deliveries[1]) == 3
+    assert environment.bot_data["in_flight"].coalesced == 1
+
+
+def test_jobs_sharing_tracks_in_opposite_order(environment: Environment):
+    tracks = [make_track("songs", "album") for _ in range(3)]
+    jobs = [
+        environment.make_job(1, environment.add_album(tracks)),
+        environment.make_job(2, environment.add_album(tracks[::-1])),
+    ]
+    assert asyncio.run(run_jobs(*jobs)) == [0, 0]
+    assert len(environment.bot.deliveries[1]) == 3
+    assert len(environment.bot.deliveries[2]) == 3
+
+
+def test_later_position_never_claims_first(environment: Environment, tmp_path: Path):
+    # Each job's first track is looked up slowly, which used to let its
+    # second track claim first and wait on the other job's stuck claim.
+    first, second = (make_track("songs", "album") for _ in range(2))
+    jobs = [
+        environment.make_job(
+            user_id,
+            environment.add_album(tracks),
+            file_id_cache=SlowFileIdCache(
+                "1", tmp_path / f"file_ids-{user_id}.sqlite3", slow={tracks[0]["id"]}
+            ),
+        )
+        for user_id, tracks in ((1, [first, second]), (2, [second, first]))
+    ]
+    try:
+        assert asyncio.run(run_jobs(*jobs)) == [0, 0]
+    finally:
+        for job in jobs:
+            job.file_id_cache.close()
+    assert len(environment.bot.deliveries[1]) == 2
+    assert len(environment.bot.deliveries[2]) == 2
+
+
+def test_cached_tracks_join_the_media_group(environment: Environment):
+    tracks = [make_track("songs", "album") for _ in range(3)]
+    url = environment.add_album(tracks)
+    assert asyncio.run(run_jobs(environment.make_job(1, url))) == [0]
+    environment.bot.deliveries.clear()
+    assert asyncio.run(run_jobs(environment.make_job(1, url))) == [0]
+    deliveries = environment.bot.deliveries[1]
+    assert len(deliveries) == 3 and len(set(deliveries)) == 1
+
+
+def test_upload_failure_only_fails_its_track(
+    environment: Environment, monkeypatch: pytest.MonkeyPatch
+):
+    tracks = [make_track("songs", "album") for _ in range(3)]
+    fit_to_size = job.fit_to_size
+
+    def fail_second(ffmpeg_path, path, output_path, track_metadata, *args):
+        if track_metadata is tracks[1]:
+            raise TooLargeError("still too large")
+        return fit_to_size(ffmpeg_path, path, output_path, track_metadata, *args)
+
+    monkeypatch.setattr(job, "fit_to_size", fail_second)
+    download_job = environment.make_job(1, environment.add_album(tracks))
+    assert asyncio.run(run_jobs(download_job)) == [1]
+    assert len(environment.bot.deliveries[1]) == 2
+    assert len(environment.bot_data["in_flight"]) == 0
+
+
+def test_failure_blames_the_components_it_was_prepared_with(
+    environment: Environment,
+):
+    item = PipelineItem(0, make_track("songs", "album"))
+    download_job = environment.make_job(1, environment.add_album([item.data]))
+    download_job.download_queue = SimpleNamespace(
+        tracks_metadata=[item.data], playlist_attributes=None
+    )
+    asyncio.run(download_job.prepare(item))
+    # Another track's failure rebuilds the session, and the job moves on.
+    environment.session.refresh()
+    download_job.update_components()
+    error = Exception("Request failed with status code 401")
+    asyncio.run(download_job.fail(item, error))
+    assert environment.session.refresh_count == 2
@@ -0,0 +1,49 @@
+from __future__ import annotations
+import time
+from pathlib import Path
+import pytest
+from job_store import JobStore
+
+
+@pytest.fixture
+def job_store(tmp_path: Path):
+    job_store = JobStore(tmp_path / "jobs.sqlite3")
+    yield job_store
+    job_store.close()
+
+
+def test_claims_oldest_queued_job(job_store: JobStore):
+    first = job_store.add_job(1, 1, 1, "https://example.invalid/1", "1/2")
+    job_store.add_job(1, 1, 1, "https://example.invalid/2", "2/2")
+    record = job_store.claim_job("worker-1", lease=60)
+    assert record.id == first.id
+    assert record.url == first.url
+
+
+def test_job_is_claimed_once(job_store: JobStore):
+    job_store.add_job(1, 1, 1, "https://example.invalid/1", "1/1")
+    assert job_store.claim_job("worker-1", lease=60) is not None
+    assert job_store.claim_job("worker-2", lease=60) is None
+    assert job_store.count_unfinished_jobs() == {"running": 1}
+
+
+def test_stale_job_is_taken_over(job_store: JobStore, monkeypatch: pytest.MonkeyPatch):
+    record = job_store.add_job(1, 1, 1, "https://example.invalid/1", "1/1")
+    job_store.claim_job("worker-1", lease=60)
+    now = time.time()
+    monkeypatch.setattr(time, "time", lambda: now + 30)
+    job_store.heartbeat("worker-1")
+    # Within the lease of the last heartbeat.
+    monkeypatch.setattr(time, "time", lambda: now + 80)
+    assert job_store.claim_job("worker-2", lease=60) is None
+    # The worker stopped sending heartbeats.
+    monkeypatch.setattr(time, "time", lambda: now + 100)
+    assert job_store.claim_job("worker-2", lease=60).id == record.id
+    assert job_store.claim_job("worker-3", lease=60) is None
+
+
+def test_excluded_users_are_skipped(job_store: JobStore):
+    job_store.add_job(1, 1, 1, "https://example.invalid/1", "1/1")
+    second = job_store.add_job(2, 2, 1, "https://example.invalid/2", "1/1")
+    assert job_store.claim_job("worker-1", lease=60, exclude_users=[1]).id == second.id
+    assert job_store.claim_job("worker-1", lease=60, exclude_users=[1]) is None
@@ -0,0 +1,62 @@
+from __future__ import annotations
+import asyncio
+import random
+from pipeline import Pipeline, PipelineItem, Stage
+
+
+async def run_pipeline(items: list, stages: list[Stage]) -> list[PipelineItem]:
+    delivered = []
+
+    async def sink(item: PipelineItem):
+        delivered.append(item)
+
+    await asyncio.wait_for(Pipeline(stages, queue_size=2).run(items, sink), 5)
+    return delivered
+
+
+def test_delivers_in_order():
+    async def work(item: PipelineItem) -> int:
+        await asyncio.sleep(random.random() / 100)
+        return item.data * 2
+
+    delivered = asyncio.run(run_pipeline(list(range(20)), [Stage("work", work, 4)]))
+    assert [item.position for item in delivered] == list(range(20))
+    assert [item.results["work"] for item in delivered] == list(range(0, 40, 2))
+
+
+def test_skipped_and_failed_items_pass_through():
+    calls = []
+
+    async def first(item: PipelineItem) -> int | None:
+        if item.data == 1:
+            return None
+        if item.data == 2:
+            raise ValueError("broken")
+        return item.data
+
+    async def second(item: PipelineItem) -> int:
+        calls.append(item.data)
+        return item.data
+
+    delivered = asyncio.run(
+        run_pipeline([0, 1, 2, 3], [Stage("first", first), Stage("second", second)])
+    )
+    assert calls == [0, 3]
+    assert delivered[1].skipped
+    assert isinstance(delivered[2].error, ValueError)
+    assert delivered[2].error_stage == "first"
+
+
+def test_done_items_skip_later_stages():
+    async def first(item: PipelineItem) -> int:
+        item.done = item.data == 0
+        return item.data
+
+    async def second(item: PipelineItem) -> int:
+        raise AssertionError("a done item reached a later stage")
+
+    delivered = asyncio.run(
+        run_pipeline([0], [Stage("first", first), Stage("second", second)])
+    )
+    assert delivered[0].done
+    assert delivered[0].error is None
@@ -0,0 +1,61 @@
+from __future__ import annotations
+from gamdl.enums import MusicVideoCodec, PostQuality, SongCodec
+from profiles import Profile
+
+BUDGET = 40_000_000
+
+
+def make_profile(size_budget: int = BUDGET) -> Profile:
+    return Profile(
+        "test",
+        SongCodec.AAC_LEGACY,
+        MusicVideoCodec.H265,
+        PostQuality.BEST,
+        1200,
+        size_budget,
+    )
+
+
+def make_track(duration: int) -> dict:
+    return {"attributes": {"durationInMillis": duration * 1000}}
+
+
+def make_playlist(codecs: str, bandwidth: int) -> dict:
+    return {"stream_info": {"codecs": codecs, "bandwidth": bandwidth}}
+
+
+def test_fitting_renditions_are_kept_per_codec():
+    playlists = [
+        make_playlist("avc1.640028", 500_000),
+        make_playlist("avc1.640028", 1_000_000),
+        make_playlist("avc1.640028", 4_000_000),
+        make_playlist("hvc1.2.4.L123", 6_000_000),
+        make_playlist("hvc1.2.4.L123", 2_000_000),
+    ]
+    # 40 MB over 4 minutes leaves about 1 Mbit/s for the video.
+    fitted = make_profile().fit_playlists(make_track(240), playlists)
+    # No H.265 rendition fits, so its smallest one is kept.
+    assert fitted == [playlists[0], playlists[1], playlists[4]]
+
+
+def test_without_budget_every_rendition_is_kept():
+    playlists = [make_playlist("avc1.640028", 50_000_000)]
+    assert make_profile(0).fit_playlists(make_track(240), playlists) == playlists
+
+
+def test_long_song_falls_back_to_he_aac():
+    profile = make_profile(10_000_000)
+    # 256 kbit/s for 2 minutes is about 3.8 MB, for 10 minutes 19.2 MB.
+    assert profile.get_song_codec(make_track(120)) == SongCodec.AAC_LEGACY
+    assert profile.get_song_codec(make_track(600)) == SongCodec.AAC_HE_LEGACY
+    assert make_profile(0).get_song_codec(make_track(600)) == SongCodec.AAC_LEGACY
+
+
+def test_budget_is_part_of_the_cache_key():
+    budgeted = make_profile().get_cache_key("songs", "1")
+    unbudgeted = make_profile(0).get_cache_key("songs", "1")
+    assert unbudgeted == ("1", SongCodec.AAC_LEGACY.value, 1200)
+    assert budgeted == ("1", f"{SongCodec.AAC_LEGACY.value}<{BUDGET}", 1200)
+    assert make_profile().get_cache_key("music-videos", "1")[1] == (
+        f"{MusicVideoCodec.H265.value}<{BUDGET}"
+    )
@@ -0,0 +1,90 @@
+from __future__ import annotations
+import asyncio
+from scheduler import PRIORITY_BULK, PRIORITY_SINGLE, FairGate, get_priority
+
+
+def test_get_priority():
+    assert get_priority("https://music.apple.com/us/song/x/1") == PRIORITY_SINGLE
+    assert get_priority("https://music.apple.com/us/album/x/1?i=2") == PRIORITY_SINGLE
+    assert get_priority("https://music.apple.com/us/album/x/1") == PRIORITY_BULK
+
+
+async def record_order(gate: FairGate, requests: list[tuple[int, int]]) -> list:
+    order = []
+    release = asyncio.Event()
+
+    async def hold_first():
+        async with gate.slot(0):
+            await release.wait()
+
+    async def take(user_id: int, priority: int):
+        async with gate.slot(user_id, priority):
+            order.append((user_id, priority))
+
+    blocker = asyncio.create_task(hold_first())
+    await asyncio.sleep(0)
+    tasks = []
+    for user_id, priority in requests:
+        tasks.append(asyncio.create_task(take(user_id, priority)))
+        await asyncio.sleep(0)
+    release.set()
+    await asyncio.wait_for(asyncio.gather(blocker, *tasks), 5)
+    return order
+
+
+def test_users_take_turns():
+    order = asyncio.run(
+        record_order(FairGate(1, 1), [(1, PRIORITY_BULK)] * 3 + [(2, PRIORITY_BULK)])
+    )
+    assert [user_id for user_id, _ in order] == [1, 2, 1, 1]
+
+
+def test_lower_priority_value_goes_first():
+    order = asyncio.run(
+        record_order(FairGate(1, 1), [(1, PRIORITY_BULK), (2, PRIORITY_SINGLE)])
+    )
+    assert order == [(2, PRIORITY_SINGLE), (1, PRIORITY_BULK)]
+
+
+def test_max_per_user():
+    async def run() -> int:
+        gate = FairGate(4, 2)
+        active = peak = 0
+
+        async def take():
+            nonlocal active, peak
+            async with gate.slot(1):
+                active += 1
+                peak = max(peak, active)
+                await asyncio.sleep(0.01)
+                active -= 1
+
+        await asyncio.wait_for(asyncio.gather(*(take() for _ in range(6))), 5)
+        return peak
+
+    assert asyncio.run(run()) == 2
+
+
+def test_cancelled_waiter_frees_its_place():
+    async def run():
+        gate = FairGate(1, 1)
+        release = asyncio.Event()
+
+        async def hold():
+            async with gate.slot(1):
+                await release.wait()
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        release.set()
+        await holder
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert gate.active == 0
+        assert gate.waiting == 0
+        async with gate.slot(2):
+            assert gate.active == 1
+
+    asyncio.run(asyncio.wait_for(run(), 5))
@@ -0,0 +1,32 @@
+from __future__ import annotations
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from types import SimpleNamespace
+from artwork import ArtworkCache
+from session import DownloaderSession
+
+
+class FakeSession(DownloaderSession):
+    def build(self):
+        return SimpleNamespace()
+
+
+def test_expired_session_is_rebuilt_once(tmp_path: Path):
+    session = FakeSession(artwork=ArtworkCache(tmp_path))
+    session.refresh()
+    built_at = session.created_at
+    error = Exception("Request failed with status code 401")
+    # Every track of an album failing with the same expired components.
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda _: session.handle_error(error, built_at), range(30)))
+    assert session.refresh_count == 2
+    # A failure with the new components rebuilds again.
+    session.handle_error(error, session.created_at)
+    assert session.refresh_count == 3
+
+
+def test_other_errors_keep_the_session(tmp_path: Path):
+    session = FakeSession(artwork=ArtworkCache(tmp_path))
+    session.refresh()
+    assert not session.handle_error(Exception("status code 404"), session.created_at)
+    assert session.refresh_count == 1
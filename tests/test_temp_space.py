@@ -0,0 +1,26 @@
+from __future__ import annotations
+import shutil
+from pathlib import Path
+from types import SimpleNamespace
+import pytest
+from temp_space import TempSpace
+
+
+def test_reservations_fit_the_budget(tmp_path: Path):
+    temp_space = TempSpace(tmp_path / "disk", tmp_path, budget=100)
+    assert temp_space.reserve(60) == tmp_path
+    assert temp_space.reserve(60) == tmp_path / "disk"
+    assert temp_space.spills == 1
+    temp_space.release(tmp_path, 60)
+    assert temp_space.reserve(60) == tmp_path
+    assert temp_space.reserved == 60
+
+
+def test_reservations_fit_the_free_space(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+):
+    # Another worker filled the shared tmpfs.
+    monkeypatch.setattr(shutil, "disk_usage", lambda path: SimpleNamespace(free=50))
+    temp_space = TempSpace(tmp_path / "disk", tmp_path, budget=100)
+    assert temp_space.reserve(60) == tmp_path / "disk"
+    assert temp_space.reserve(40) == tmp_path
@@ -0,0 +1,98 @@
+from __future__ import annotations
+import logging
+import subprocess
+from pathlib import Path
+from mutagen import File as MutagenFile
+
+logger = logging.getLogger(__name__)
+
+# Room left for the container overhead when picking a bitrate.
+SIZE_MARGIN = 0.92
+AUDIO_BITRATES = (256_000, 192_000, 128_000, 96_000, 64_000)
+VIDEO_AUDIO_BITRATE = 128_000
+MIN_VIDEO_BITRATE = 100_000
+
+
+class TooLargeError(Exception):
+    pass
+
+
+def get_duration(path: Path, track_metadata: dict) -> float:
+    duration_ms = track_metadata["attributes"].get("durationInMillis")
+    if duration_ms:
+        return duration_ms / 1000
+    return MutagenFile(path).info.length
+
+
+def fit_to_size(
+    ffmpeg_path: str,
+    path: Path,
+    output_path: Path,
+    track_metadata: dict,
+    size_limit: int,
+    video: bool,
+) -> Path:
+    """Return ``path`` if it fits in ``size_limit`` bytes, otherwise a re-encode that does.
+
+    Songs are converted to AAC at the highest bitrate that fits, videos
+    to H.264 with the video bitrate derived from the duration.
+    """
+    if path.stat().st_size <= size_limit:
+        return path
+    duration = get_duration(path, track_metadata)
+    bitrate = int(size_limit * 8 * SIZE_MARGIN / duration)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    if video:
+        video_bitrate = bitrate - VIDEO_AUDIO_BITRATE
+        if video_bitrate < MIN_VIDEO_BITRATE:
+            raise TooLargeError(
+                f'"{path}" cannot be re-encoded to fit the upload limit'
+            )
+        codec_args = [
+            "-c:v",
+            "libx264",
+            "-b:v",
+            str(video_bitrate),
+            "-maxrate",
+            str(video_bitrate),
+            "-bufsize",
+            str(video_bitrate * 2),
+            "-c:a",
+            "aac",
+            "-b:a",
+            str(VIDEO_AUDIO_BITRATE),
+            "-movflags",
+            "+faststart",
+        ]
+    else:
+        audio_bitrate = next(
+            (candidate for candidate in AUDIO_BITRATES if candidate <= bitrate), None
+        )
+        if audio_bitrate is None:
+            raise TooLargeError(
+                f'"{path}" cannot be re-encoded to fit the upload limit'
+            )
+        codec_args = ["-vn", "-c:a", "aac", "-b:a", str(audio_bitrate)]
+    logger.info(
+        f'"{path.name}" is over the upload limit, re-encoding to "{output_path}"'
+    )
+    subprocess.run(
+        [
+            ffmpeg_path,
+            "-loglevel",
+            "error",
+            "-y",
+            "-i",
+            str(path),
+            "-map_metadata",
+            "0",
+            *codec_args,
+            str(output_path),
+        ],
+        check=True,
+    )
+    if output_path.stat().st_size > size_limit:
+        raise TooLargeError(
+            f'"{path}" is still over the upload limit after re-encoding'
+        )
+    return output_path